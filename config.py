@@ -9,5 +9,6 @@ ASSET_DB = 'einszwo_internal'
 # Collections
 CONNECTOR_REGISTRY = 'registry'
 CONNECTOR_MAPPINGS = 'mappings'
+CONNECTOR_QUOTA = 'quota'
 
 ASSETS = 'assets'
@@ -15,6 +15,17 @@ api = Blueprint('api', __name__)
 config = OverwritableConfiguration.create_from_file('%s/config/config.json' % APP_ROOT)
 
 
+def config_property(key, default=None):
+    """ Reads an optional property from the configuration. If the property is not
+    configured the given default is returned instead.
+    """
+    try:
+        value = config.property(key)
+    except Exception:
+        return default
+    return default if value is None else value
+
+
 def mongo_connection_url(system):
     if system == 'internal':
         return CONNECTOR_MONGO_DB if 'CONNECTOR_MONGO_DB' not in os.environ else os.environ['CONNECTOR_MONGO_DB']
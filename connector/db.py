@@ -3,6 +3,9 @@ import os
 import traceback
 import uuid
 import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import pytz
 
 from bson import ObjectId
@@ -11,8 +14,12 @@ from gridfs import GridFS
 from pymongo import MongoClient
 
 from config import CONNECTOR_MONGO_DB, ASSET_MONGO_DB, CONNECTOR_DB, CONNECTOR_REGISTRY, CONNECTOR_MAPPINGS, ASSET_DB, \
-    ASSETS
-from connector import external_client, internal_client
+    ASSETS, CONNECTOR_QUOTA
+from connector import external_client, internal_client, config_property
+from connector.cache import TTLCache
+
+MAPPING_CACHE_TTL = 300
+MAPPING_CACHE_SIZE = 1000
 
 
 class MongoDbFactory(object):
@@ -36,6 +43,11 @@ class MongoDbFactory(object):
         log_debug('retrieving mappings collection...')
         return MongoDbFactory._create_mongo_db_client_for_system('internal')[CONNECTOR_DB][CONNECTOR_MAPPINGS]
 
+    @staticmethod
+    def connector_quota_collection():
+        log_debug('retrieving quota collection...')
+        return MongoDbFactory._create_mongo_db_client_for_system('internal')[CONNECTOR_DB][CONNECTOR_QUOTA]
+
     @staticmethod
     def assets_collection():
         log_debug('retrieving assets collection')
@@ -47,10 +59,39 @@ class MongoDbFactory(object):
         return MongoDbFactory._create_mongo_db_client_for_system('external')[ASSET_DB]
 
 
+class StaleRegistryException(Exception):
+    """ Raised if an update of a registry entry did not match, because the entry was changed or
+    deleted concurrently.
+    """
+
+
 class RegistryModel(object):
     db_factory = MongoDbFactory
 
+    # persisted attributes and their keys in the registry document
+    fields = OrderedDict((
+        ('video_id', 'videoId'),
+        ('category_id', 'categoryId'),
+        ('status', 'status'),
+        ('intermediate_state', 'intermediateState'),
+        ('message', 'message'),
+        ('target_platform', 'targetPlatform'),
+        ('target_platform_video_id', 'targetPlatformVideoId'),
+        ('mapping_id', 'mappingId'),
+        ('video_hash_code', 'video_hash_code'),
+        ('last_update', 'lastUpdate'),
+        ('captions_uploaded', 'captionsUploaded'),
+        ('upload_session', 'uploadSession'),
+        ('claim_status', 'claimStatus'),
+        ('asset_id', 'assetId')
+    ))
+
+    # fields written immediately even if persisting is deferred, as crash recovery relies on them
+    checkpoint_fields = frozenset(('intermediate_state', 'target_platform_video_id', 'upload_session', 'claim_status'))
+
     def __init__(self):
+        self._dirty = set()
+        self._deferred = 0
         self.registry_id = None
         self.video_id = None
         self.category_id = None
@@ -63,23 +104,31 @@ class RegistryModel(object):
         self.video_hash_code = None
         self.last_update = None
         self.captions_uploaded = False
+        self.upload_session = None
+        self.claim_status = None
+        self.asset_id = None
+
+    def __setattr__(self, name, value):
+        if name in RegistryModel.fields and (name not in self.__dict__ or self.__dict__[name] != value):
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
 
     def update_video_hash_code(self, hash_code):
         self.video_hash_code = hash_code
         self._persist()
 
-    def set_state_and_persist(self, state):
+    def set_state_and_persist(self, state, expected_state=None):
         self.status = state
-        self._persist()
+        self._persist(None if expected_state is None else {'status': expected_state})
 
     def set_state_and_message_and_persist(self, state, message):
         self.status = state
         self.message = message
         self._persist()
 
-    def set_intermediate_state_and_persist(self, state):
+    def set_intermediate_state_and_persist(self, state, expected_state=None):
         self.intermediate_state = state
-        self._persist()
+        self._persist(None if expected_state is None else {'intermediate_state': expected_state})
 
     def set_message_and_persist(self, message):
         self.message = message
@@ -89,30 +138,68 @@ class RegistryModel(object):
         self.captions_uploaded = captions_uploaded
         self._persist()
 
-    def _persist(self):
+    def set_upload_session_and_persist(self, upload_session):
+        self.upload_session = upload_session
+        self._persist()
+
+    def set_claim_status_and_persist(self, claim_status):
+        self.claim_status = claim_status
+        self._persist()
+
+    def set_asset_id_and_persist(self, asset_id):
+        self.asset_id = asset_id
+        self._persist()
+
+    @contextmanager
+    def deferred_persist(self):
+        """ Unit of work for the registry entry. Within the block all changes are only collected
+        and written with a single update when the outermost block is left. Changes of checkpoint
+        fields and compare-and-set updates are still written immediately, together with all
+        changes collected so far.
+        """
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+            if not self._deferred:
+                self.flush()
+
+    def flush(self):
+        if self._dirty:
+            self._write()
+
+    def _persist(self, expected=None):
+        if self._deferred and not expected and not self._dirty & RegistryModel.checkpoint_fields:
+            log_debug('Deferring update of registry item with id %s.' % self.registry_id)
+            return
+        self._write(expected)
+
+    def _write(self, expected=None):
+        """ Writes all changed fields of the registry entry with a single $set update. The entry is
+        never created, a partial document could not be loaded again.
+
+        :param expected: optional dict of attribute name to value. If given, the entry is only
+        updated if its stored values still match.
+        :raises StaleRegistryException: if the entry does not exist or does not match the expected values
+        """
         collection = RegistryModel.db_factory.connector_registry_collection()
         try:
             self.last_update = datetime.datetime.now(pytz.utc)
-            collection.save(self._to_dict())
+            changes = {key: getattr(self, name) for name, key in RegistryModel.fields.items() if name in self._dirty}
+            query = {'_id': self.registry_id}
+            if expected:
+                query.update({RegistryModel.fields[name]: value for name, value in expected.items()})
+            result = collection.update_one(query, {'$set': changes})
         except Exception as e:
             traceback.print_exc()
             raise Exception('Cannot update state of registry item with id %s.' % self.registry_id) from e
-
-    def _to_dict(self):
-        return dict(
-            _id=self.registry_id,
-            videoId=self.video_id,
-            categoryId=self.category_id,
-            status=self.status,
-            intermediateState=self.intermediate_state,
-            message=self.message,
-            targetPlatform=self.target_platform,
-            targetPlatformVideoId=self.target_platform_video_id,
-            mappingId=self.mapping_id,
-            video_hash_code=self.video_hash_code,
-            lastUpdate=self.last_update,
-            captionsUploaded=self.captions_uploaded
-        )
+        if result.matched_count == 0 and expected:
+            raise StaleRegistryException('Registry item with id %s was modified concurrently, expected %s.' % (
+                self.registry_id, expected))
+        if result.matched_count == 0:
+            raise StaleRegistryException('Registry item with id %s was deleted concurrently.' % self.registry_id)
+        self._dirty.clear()
 
     @classmethod
     def create_from_registry_id(cls, registry_id):
@@ -121,20 +208,7 @@ class RegistryModel(object):
         try:
             registry_obj = collection.find_one({'_id': registry_id})
             log_debug('Found matching registry entry...')
-            obj = cls()
-            obj.registry_id = registry_id
-            obj.video_id = registry_obj['videoId']
-            obj.category_id = registry_obj['categoryId']
-            obj.status = registry_obj['status']
-            obj.message = registry_obj['message']
-            obj.target_platform = registry_obj['targetPlatform']
-            obj.target_platform_video_id = registry_obj[
-                'targetPlatformVideoId'] if 'targetPlatformVideoId' in registry_obj else ''
-            obj.mapping_id = registry_obj['mappingId']
-            obj.intermediate_state = registry_obj['intermediateState'] if 'intermediateState' in registry_obj else ''
-            obj.video_hash_code = registry_obj['video_hash_code'] if 'video_hash_code' in registry_obj else ''
-            obj.last_update = registry_obj['lastUpdate'] if 'lastUpdate' in registry_obj else None
-            obj.captions_uploaded = registry_obj['captionsUploaded'] if 'captionsUploaded' in registry_obj else False
+            obj = cls._create_from_dict(registry_id, registry_obj)
             log_debug('Loaded registry entry with id %s successfully.' % registry_id)
             return obj
         except Exception as e:
@@ -142,6 +216,76 @@ class RegistryModel(object):
             log_error(e.__traceback__)
             raise Exception('Cannot create registry model for registry id %s.' % registry_id) from e
 
+    @classmethod
+    def create_from_registry_ids(cls, registry_ids):
+        """ Loads the registry entries for all given ids with a single query.
+
+        :param registry_ids: ids of the registry entries to load
+        :return: dict mapping registry id to registry model. Unknown ids are not contained.
+        """
+        log_debug('Creating registry models for %s registry ids.' % len(registry_ids))
+        collection = RegistryModel.db_factory.connector_registry_collection()
+        try:
+            return {registry_obj['_id']: cls._create_from_dict(registry_obj['_id'], registry_obj)
+                    for registry_obj in collection.find({'_id': {'$in': list(registry_ids)}})}
+        except Exception as e:
+            traceback.print_exc()
+            log_error(e.__traceback__)
+            raise Exception('Cannot create registry models for %s registry ids.' % len(registry_ids)) from e
+
+    @classmethod
+    def find_unfinished(cls):
+        """ Loads the registry entries whose workflow did not finish, i.e. new entries and entries with an
+        intermediate state which did not end in the error state. Used to schedule them again after a restart.
+
+        :return: dict mapping registry id to registry model
+        """
+        return cls._find({'$or': [
+            {'status': 'notified'},
+            {'status': {'$ne': 'error'}, 'intermediateState': {'$nin': ['', None]}}
+        ]})
+
+    @classmethod
+    def find_pending_claims(cls):
+        """ Loads the youtube registry entries whose content id claim is scheduled but not finished.
+
+        :return: dict mapping registry id to registry model
+        """
+        return cls._find({'targetPlatform': 'youtube', 'claimStatus': 'pending'})
+
+    @classmethod
+    def _find(cls, query):
+        collection = RegistryModel.db_factory.connector_registry_collection()
+        try:
+            return {registry_obj['_id']: cls._create_from_dict(registry_obj['_id'], registry_obj)
+                    for registry_obj in collection.find(query)}
+        except Exception as e:
+            traceback.print_exc()
+            log_error(e.__traceback__)
+            raise Exception('Cannot create registry models for query %s.' % query) from e
+
+    @classmethod
+    def _create_from_dict(cls, registry_id, registry_obj):
+        obj = cls()
+        obj.registry_id = registry_id
+        obj.video_id = registry_obj['videoId']
+        obj.category_id = registry_obj['categoryId']
+        obj.status = registry_obj['status']
+        obj.message = registry_obj['message']
+        obj.target_platform = registry_obj['targetPlatform']
+        obj.target_platform_video_id = registry_obj[
+            'targetPlatformVideoId'] if 'targetPlatformVideoId' in registry_obj else ''
+        obj.mapping_id = registry_obj['mappingId']
+        obj.intermediate_state = registry_obj['intermediateState'] if 'intermediateState' in registry_obj else ''
+        obj.video_hash_code = registry_obj['video_hash_code'] if 'video_hash_code' in registry_obj else ''
+        obj.last_update = registry_obj['lastUpdate'] if 'lastUpdate' in registry_obj else None
+        obj.captions_uploaded = registry_obj['captionsUploaded'] if 'captionsUploaded' in registry_obj else False
+        obj.upload_session = registry_obj['uploadSession'] if 'uploadSession' in registry_obj else None
+        obj.claim_status = registry_obj['claimStatus'] if 'claimStatus' in registry_obj else None
+        obj.asset_id = registry_obj['assetId'] if 'assetId' in registry_obj else None
+        obj._dirty.clear()
+        return obj
+
 
 class VideoModel(object):
     db_factory = MongoDbFactory
@@ -159,6 +303,8 @@ class VideoModel(object):
         self.image_filename = None
         self.captions_filename = None
         self.captions_uploaded = False
+        self.duration = None
+        self.file_size = None
 
     @classmethod
     def create_from_video_id(cls, video_id):
@@ -176,6 +322,7 @@ class VideoModel(object):
             video.download_url = video_dict['flavourSourceUrl'] if 'flavourSourceUrl' in video_dict else None
             video.captions_url = video_dict['captionsUrl'] if 'captionsUrl' in video_dict else None
             video.image_id = video_dict['imageid'] if 'imageid' in video_dict else None
+            video.duration = video_dict['duration'] if 'duration' in video_dict else None
             video_hash_code = hashlib.md5()
             video_hash_code.update(bytes(video.title.encode('UTF-8')))
             video_hash_code.update(bytes(video.description.encode('UTF-8')))
@@ -214,6 +361,8 @@ def persist_video_image_on_disk(video_model: VideoModel):
 
 class MappingModel(object):
     db_factory = MongoDbFactory
+    cache = TTLCache(int(config_property('mapping_cache.ttl', MAPPING_CACHE_TTL)),
+                     int(config_property('mapping_cache.size', MAPPING_CACHE_SIZE)))
 
     def __init__(self):
         self._id = None
@@ -223,14 +372,32 @@ class MappingModel(object):
 
     @classmethod
     def create_from_mapping_id(cls, mapping_id):
+        mapping_dict = MappingModel.cache.get(str(mapping_id))
+        if mapping_dict is None:
+            mapping_dict = cls._load_mapping(mapping_id)
+            MappingModel.cache.put(str(mapping_id), mapping_dict)
+        mapping = cls()
+        mapping.target_id = mapping_dict['target_id']
+        mapping.target_platform = mapping_dict['target_platform']
+        mapping.category_id = mapping_dict['category_id']
+        return mapping
+
+    @classmethod
+    def invalidate_cache(cls, mapping_id=None):
+        """ Removes the mapping with the given id from the cache. Clears the whole cache if no id is given. """
+        log_debug('Invalidating cached mapping %s.' % (mapping_id or '(all)'))
+        MappingModel.cache.invalidate(None if mapping_id is None else str(mapping_id))
+
+    @classmethod
+    def _load_mapping(cls, mapping_id):
         collection = MappingModel.db_factory.connector_mappings_collection()
         try:
             mapping_dict = collection.find_one({'_id': ObjectId(mapping_id)})
-            mapping = cls()
-            mapping.target_id = mapping_dict['target_id']
-            mapping.target_platform = mapping_dict['target_platform']
-            mapping.category_id = mapping_dict['category_id']
-            return mapping
+            return dict(
+                target_id=mapping_dict['target_id'],
+                target_platform=mapping_dict['target_platform'],
+                category_id=mapping_dict['category_id']
+            )
         except Exception as e:
             log_error(e.__traceback__)
             traceback.print_exc()
@@ -0,0 +1,343 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from commonspy.logging import log_info, log_warning, log_debug
+
+from connector import config_property
+
+""" This module handles the download of video binaries from
+kaltura. Downloads are streamed to disk and resumed with
+http range requests if the connection breaks. Large files
+can be fetched in several segments concurrently or be
+streamed directly into an upload (see PipelinedDownload).
+"""
+BLOCK_SIZE = 1024 * 1024
+MAX_RETRY = 5
+RETRY_WAIT_SECONDS = 5
+TIMEOUT = 60
+# Number of concurrent connections per download. 1 disables segmented downloads.
+SEGMENTS = 1
+# Files smaller than this are always downloaded with a single connection.
+SEGMENT_THRESHOLD = 256 * 1024 * 1024
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+UNSATISFIED_CONTENT_RANGE_PATTERN = re.compile(r'bytes \*/(\d+)')
+
+
+class DownloadError(OSError):
+    """ Raised if a download cannot be completed. """
+
+
+def download_file(url, filename):
+    """
+    Download the resource at url to filename. The response is written to disk in blocks of BLOCK_SIZE. If the
+    connection breaks, the download is resumed from the last written byte with a range request. Finally the length
+    of the file is verified.
+
+    If download.segments is configured to more than one connection and the file is larger than
+    download.segment_threshold, the file is fetched in that many byte ranges concurrently (see download_segmented).
+
+    :param url: url of the resource to download
+    :param filename: target file
+    """
+    segments = int(config_property('download.segments', SEGMENTS))
+    threshold = int(config_property('download.segment_threshold', SEGMENT_THRESHOLD))
+    with requests.Session() as session:
+        size = _segmentable_size(session, url) if segments > 1 else None
+        if size is not None and size >= threshold:
+            download_segmented(url, filename, size, segments)
+        else:
+            state = [None, None]
+
+            def download_remainder():
+                state[:] = _download_remainder(session, url, filename, *state)
+
+            _with_retries(url, download_remainder)
+    log_debug('Downloaded %s bytes from %s to %s.' % (os.path.getsize(filename), url, filename))
+
+
+def download_segmented(url, filename, size, segments):
+    """
+    Download the resource at url to filename by fetching the given number of byte ranges concurrently. The file is
+    preallocated and every segment is written in place. Each segment is resumed on its own if its connection breaks.
+
+    :param url: url of the resource to download, the server has to support range requests
+    :param filename: target file
+    :param size: size of the resource in bytes
+    :param segments: number of concurrent connections
+    """
+    log_info('Downloading %s bytes from %s in %s segments.' % (size, url, segments))
+    with open(filename, 'wb') as file:
+        file.truncate(size)
+
+    segment_size = -(-size // segments)
+    ranges = [_Segment(url, filename, start, min(start + segment_size, size) - 1)
+              for start in range(0, size, segment_size)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(segment.download) for segment in ranges]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        raise DownloadError('Segmented download of %s failed for %s of %s segments.' % (
+            url, len(errors), len(ranges))) from errors[0]
+
+    if os.path.getsize(filename) != size:
+        raise DownloadError('Download of %s incomplete, got %s of %s bytes.' % (url, os.path.getsize(filename), size))
+
+
+class _Segment(object):
+    def __init__(self, url, filename, start, end):
+        self.url = url
+        self.filename = filename
+        self.position = start
+        self.end = end
+
+    def download(self):
+        with requests.Session() as session, open(self.filename, 'r+b') as file:
+            _with_retries(self.url, lambda: self._download_remainder(session, file))
+
+    def _download_remainder(self, session, file):
+        headers = {
+            'Accept-Encoding': 'identity',
+            'Range': 'bytes=%d-%d' % (self.position, self.end)
+        }
+        response = session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT)
+        try:
+            if response.status_code != 206:
+                raise DownloadError('Unexpected response status %s downloading range %s of %s.' % (
+                    response.status_code, headers['Range'], self.url))
+            file.seek(self.position)
+            for block in response.iter_content(BLOCK_SIZE):
+                block = block[:self.end + 1 - self.position]
+                file.write(block)
+                self.position += len(block)
+        finally:
+            response.close()
+        if self.position <= self.end:
+            raise DownloadError('Range %s-%s of %s incomplete.' % (self.position, self.end, self.url))
+
+
+def _segmentable_size(session, url):
+    """ Returns the size of the resource if the server supports range requests for it, otherwise None. """
+    try:
+        response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        log_warning('Cannot determine size of %s, downloading it with a single connection. Error: %s' % (url, e))
+        return None
+    if response.status_code != 200 or response.headers.get('Accept-Ranges') != 'bytes' \
+            or 'Content-Length' not in response.headers:
+        return None
+    return int(response.headers['Content-Length'])
+
+
+def _with_retries(url, function):
+    retry = 0
+    while True:
+        try:
+            return function()
+        except (requests.RequestException, OSError) as e:
+            retry += 1
+            if retry > MAX_RETRY:
+                raise DownloadError('Giving up download of %s after %s retries.' % (url, MAX_RETRY)) from e
+            log_warning('Error downloading %s. Resuming download. Retry: %s/%s. Error: %s' % (url, retry, MAX_RETRY, e))
+            time.sleep(RETRY_WAIT_SECONDS)
+
+
+class PipelinedDownload(object):
+    """
+    Read only, file like view on a download in progress. A background thread streams the resource into a bounded
+    in-memory buffer and readers block until the requested bytes arrived, so that an upload can consume the video
+    while it is still being downloaded. Bytes before the position of the last seek() are dropped from the buffer,
+    hence seeking backwards behind that position is not possible. After seeking ahead of the received bytes, the
+    bytes up to the new position are discarded as they arrive instead of being buffered.
+
+    The buffer holds at most max_buffer_size bytes ahead of the readers, but grows to the size of a single read if
+    a reader requests more than that.
+    """
+
+    def __init__(self, url, max_buffer_size):
+        self.url = url
+        self.max_buffer_size = max_buffer_size
+        self._session = requests.Session()
+        self._buffer = bytearray()
+        self._base = 0
+        self._streamed = 0
+        self._position = 0
+        self._wanted = 0
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._response = self._request(0)
+        if 'Content-Length' not in self._response.headers:
+            self._response.close()
+            raise DownloadError('Cannot stream %s, size of resource unknown.' % url)
+        self.size = int(self._response.headers['Content-Length'])
+        thread = threading.Thread(target=self._stream, name='pipelined-download')
+        thread.daemon = True
+        thread.start()
+
+    def seek(self, offset):
+        with self._condition:
+            if offset < self._base:
+                raise DownloadError('Cannot seek to byte %s of %s, bytes before %s are already discarded.' % (
+                    offset, self.url, self._base))
+            discard = min(offset - self._base, len(self._buffer))
+            del self._buffer[:discard]
+            self._base += discard
+            if offset > self._base:
+                # the buffer is empty, the streaming thread drops the bytes up to the offset
+                self._base = offset
+            self._position = offset
+            self._condition.notify_all()
+
+    def read(self, size):
+        with self._condition:
+            end = min(self._position + size, self.size)
+            self._wanted = end
+            self._condition.notify_all()
+            while self._received() < end and self._error is None and not self._closed:
+                self._condition.wait()
+            if self._received() < end:
+                raise DownloadError('Streaming download of %s failed.' % self.url) from self._error
+            start = self._position - self._base
+            data = bytes(self._buffer[start:start + end - self._position])
+            self._position = end
+            return data
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _received(self):
+        return self._streamed
+
+    def _request(self, offset):
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        response = self._session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT)
+        if response.status_code != (206 if offset else 200):
+            response.close()
+            raise DownloadError('Unexpected response status %s streaming %s.' % (response.status_code, self.url))
+        return response
+
+    def _stream(self):
+        try:
+            _with_retries(self.url, self._stream_remainder)
+        except Exception as e:
+            log_warning('Streaming download of %s failed. Error: %s' % (self.url, e))
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+        finally:
+            self._session.close()
+
+    def _stream_remainder(self):
+        if self._response is None:
+            with self._condition:
+                offset = self._base + len(self._buffer)
+            log_info('Resuming streaming download of %s at byte %s.' % (self.url, offset))
+            self._response = self._request(offset)
+            with self._condition:
+                self._streamed = offset
+        try:
+            for block in self._response.iter_content(BLOCK_SIZE):
+                with self._condition:
+                    while not self._closed and len(self._buffer) >= self.max_buffer_size \
+                            and self._received() >= self._wanted:
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                    start = self._streamed
+                    self._streamed += len(block)
+                    self._buffer.extend(block[max(0, self._base + len(self._buffer) - start):])
+                    self._condition.notify_all()
+        finally:
+            self._response.close()
+            self._response = None
+        if self._received() != self.size:
+            raise DownloadError('Streaming download of %s incomplete, got %s of %s bytes.' % (
+                self.url, self._received(), self.size))
+
+
+def _download_remainder(session, url, filename, expected_size, validator):
+    """
+    Downloads the part of the resource not yet written to filename. A partial file is only resumed if it was written
+    by an earlier attempt of this download, the range request is made conditional on the validator (ETag or
+    Last-Modified) of that attempt, so a changed resource (e.g. a new flavor) is downloaded from scratch.
+
+    :return: tuple of the expected size of the file and the validator of the downloaded resource
+    """
+    offset = os.path.getsize(filename) if os.path.isfile(filename) else 0
+    if offset and offset == expected_size:
+        return expected_size, validator
+    if expected_size is not None and offset > expected_size:
+        log_warning('Downloaded file %s is larger than %s, restarting download.' % (filename, url))
+        offset = 0
+    elif offset and validator is None:
+        log_warning('Cannot verify partial file %s against %s, restarting download.' % (filename, url))
+        offset = 0
+
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        log_info('Resuming download of %s at byte %s.' % (url, offset))
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+
+    response = session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+    try:
+        if offset and response.status_code == 416 \
+                and _size_from_unsatisfied_content_range(response.headers.get('Content-Range')) == offset:
+            log_info('Download of %s to %s already complete.' % (url, filename))
+            return offset, validator
+        if offset and response.status_code == 206:
+            if _start_from_content_range(response.headers.get('Content-Range')) != offset:
+                raise DownloadError('Unexpected content range %s resuming %s at byte %s.' % (
+                    response.headers.get('Content-Range'), url, offset))
+            mode = 'ab'
+            expected_size = _size_from_content_range(response.headers.get('Content-Range')) or expected_size
+        elif response.status_code == 200:
+            # either a fresh download, a changed resource or the server does not support ranges, so start from scratch
+            mode = 'wb'
+            validator = _validator(response)
+            expected_size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+        else:
+            raise DownloadError('Unexpected response status %s downloading %s.' % (response.status_code, url))
+
+        with open(filename, mode) as file:
+            for block in response.iter_content(BLOCK_SIZE):
+                file.write(block)
+    finally:
+        response.close()
+
+    size = os.path.getsize(filename)
+    if expected_size is not None and size != expected_size:
+        raise DownloadError('Download of %s incomplete, got %s of %s bytes.' % (url, size, expected_size))
+    return expected_size, validator
+
+
+def _validator(response):
+    """ Returns the strong validator of the response usable in an If-Range header, or None if there is none. """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _start_from_content_range(content_range):
+    match = CONTENT_RANGE_PATTERN.match(content_range or '')
+    return int(match.group(1)) if match else None
+
+
+def _size_from_unsatisfied_content_range(content_range):
+    match = UNSATISFIED_CONTENT_RANGE_PATTERN.match(content_range or '')
+    return int(match.group(1)) if match else None
+
+
+def _size_from_content_range(content_range):
+    match = CONTENT_RANGE_PATTERN.match(content_range or '')
+    return int(match.group(3)) if match else None
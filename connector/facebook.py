@@ -1,23 +1,119 @@
 import datetime
 import hashlib
+import json
 import os
 import traceback
-import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 import requests
 from commonspy.logging import log_info, log_warning, log_debug
+from requests.adapters import HTTPAdapter
 
+from connector import config_property
 from connector.db import MappingModel, VideoModel, RegistryModel
+from connector.download import PipelinedDownload, DownloadError
+from connector.retry import upload_retry_policy, RetryLimitExceededException
+from connector.youtube import SuccessWithWarningException
 
 API_URL = 'https://graph.facebook.com/v2.7/'
-MAX_RETRY = 5
 CHUNK_TIMEOUT = 45
-CHUNK_ERROR_WAIT_SECONDS = 2
+# Maximum number of keep-alive connections per host
+POOL_SIZE = 10
+# Bytes buffered ahead of the upload if the video is streamed from kaltura into the upload
+PIPELINE_BUFFER_SIZE = 64 * 1024 * 1024
+# Maximum number of bytes of a chunk held in memory while it is sent
+CHUNK_BLOCK_SIZE = 64 * 1024
+# Limits for videos uploaded by url (see upload_video_to_facebook_unchunked)
+URL_UPLOAD_MAX_SIZE = 1024 * 1024 * 1024
+URL_UPLOAD_MAX_DURATION = 20 * 60
+# Maximum number of operations per Graph API batch request
+BATCH_SIZE = 50
+# Number of threads uploading captions while the metadata of a video is updated
+MEDIA_WORKERS = 4
+# Graph API error subcodes of a transfer request, meaning the upload session timed out and cannot be continued
+EXPIRED_SESSION_ERROR_SUBCODES = (1363030,)
+
+
+class UploadSessionExpiredException(Exception):
+    """ Raised if facebook rejects a chunk because the upload session expired. """
+
+
+def create_session(pool_size):
+    """
+    Create a http session keeping up to pool_size connections per host alive. The session is shared by all
+    threads, so that subsequent requests (e.g. the chunks of an upload) reuse already established connections.
+
+    :param pool_size: maximum number of connections kept per host
+    :return: the session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+session = create_session(int(config_property('facebook.pool_size', POOL_SIZE)))
+_media_executor = ThreadPoolExecutor(max_workers=int(config_property('facebook.media_workers', MEDIA_WORKERS)))
+
+
+def video_binary_required_for_facebook(video: VideoModel):
+    """
+    Check whether the video binary has to be downloaded to disk before uploading it to facebook.
+
+    :param video: information about the video to upload
+    :return: False if facebook fetches the video by url or the video is streamed from kaltura directly into the upload
+    """
+    return not (_url_upload(video) or _pipelined_upload(video))
+
+
+def _pipelined_upload(video: VideoModel):
+    return str(config_property('facebook.pipelined_upload', False)).lower() == 'true' and bool(video.download_url)
+
+
+def _url_upload(video: VideoModel):
+    """ Videos with known duration that are small and short enough are fetched by facebook from the download url. """
+    if str(config_property('facebook.url_upload', True)).lower() != 'true' or not video.download_url:
+        return False
+    if video.duration is None or float(video.duration) > URL_UPLOAD_MAX_DURATION:
+        return False
+    file_size = _video_file_size(video)
+    return file_size is not None and file_size <= URL_UPLOAD_MAX_SIZE
+
+
+def _video_file_size(video: VideoModel):
+    if video.file_size is None:
+        try:
+            result = session.head(video.download_url, allow_redirects=True, timeout=CHUNK_TIMEOUT)
+            if result.status_code == 200 and 'Content-Length' in result.headers:
+                video.file_size = int(result.headers['Content-Length'])
+        except requests.RequestException as e:
+            log_warning('Cannot determine size of video %s. Error: %s' % (video.video_id, e))
+    return video.file_size
 
 
 def upload_video_to_facebook(video: VideoModel, registry: RegistryModel):
     """
-    Upload a video with thumbnail to facebook by chunking the file.
+    Upload a video with thumbnail to facebook. Videos below the size and duration limits of facebook are uploaded
+    by url, so that facebook fetches them itself. All other videos are uploaded in chunks.
+
+    :param video: information about the video to upload
+    :param registry: current status of processing
+
+    """
+    if _url_upload(video):
+        log_info('Registry: %s. Uploading video to facebook by url.' % registry.registry_id)
+        upload_video_to_facebook_unchunked(video, registry)
+    else:
+        upload_video_to_facebook_chunked(video, registry)
+
+
+def upload_video_to_facebook_chunked(video: VideoModel, registry: RegistryModel):
+    """
+    Upload a video with thumbnail to facebook by chunking the file. If facebook.pipelined_upload is enabled, the
+    chunks are read directly from the download stream of the video (see PipelinedDownload) instead of from disk.
 
     :param video: information about the video to upload
     :param registry: current status of processing
@@ -29,34 +125,32 @@ def upload_video_to_facebook(video: VideoModel, registry: RegistryModel):
     video_url = API_URL + 'me/videos'
     mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
 
+    file = None
     try:
         # START
-        file_size = os.path.getsize(video.filename)
-        body = {
-            'access_token': str(mapping.target_id),
-            'upload_phase': 'start',
-            'file_size': file_size
-        }
-        start_result = requests.post(video_url, data=body)
-
-        if start_result.status_code != 200:
-            raise Exception('Registry: %s. Error starting upload session %s' % (registry.registry_id, start_result.content))
-
-        log_debug('Registry %s. Start result: %s' % (registry.registry_id, start_result.content))
-        start_result_content = start_result.json()
-        session_id = start_result_content['upload_session_id']
-        start_offset = int(start_result_content['start_offset'])
-        end_offset = int(start_result_content['end_offset'])
-        video_id = start_result_content['video_id']
-        log_info('Registry: %s. Upload session started with session_id: %s, start_offset: %s, end_offset: %s, file_size: %s' % (registry.registry_id, session_id, start_offset, end_offset, file_size))
-
-        # TRANSFER
-        file = open(video.filename, 'rb')
-        while end_offset > start_offset:
-            percent_uploaded = (start_offset / file_size) * 100
-            log_info('Registry: %s. Uploading chunk for session_id: %s, percent done: %d%%, start_offset: %s, end_offset: %s, file_size: %s' % (
-                registry.registry_id, session_id, percent_uploaded, start_offset, end_offset, file_size))
-            start_offset, end_offset = upload_chunk(0, video_url, file, session_id, start_offset, end_offset, str(mapping.target_id), registry.registry_id)
+        file, file_size = _open_video(video, registry)
+        access_token = str(mapping.target_id)
+        upload_session = _resumable_upload_session(registry, file_size)
+        resumed = upload_session is not None
+        if upload_session:
+            log_info('Registry: %s. Resuming upload session %s at start_offset: %s' % (
+                registry.registry_id, upload_session['session_id'], upload_session['start_offset']))
+            try:
+                upload_session = _transfer_chunks(video_url, file, upload_session, access_token, registry)
+            except UploadSessionExpiredException as e:
+                log_warning('Registry: %s. Upload session %s expired, starting new session. Error: %s' % (
+                    registry.registry_id, upload_session['session_id'], e))
+                upload_session = None
+                # a streamed video cannot seek back to the start, so the video is opened again
+                file.close()
+                file, file_size = _open_video(video, registry)
+
+        if not upload_session:
+            resumed = False
+            upload_session = _start_upload_session(video_url, file_size, access_token, registry)
+            upload_session = _transfer_chunks(video_url, file, upload_session, access_token, registry)
+        session_id = upload_session['session_id']
+        video_id = upload_session['video_id']
 
         # FINISH
         log_info('Registry: %s. Uploading chunks finished. Sending finsh request session_id: %s' % (registry.registry_id, session_id))
@@ -72,58 +166,214 @@ def upload_video_to_facebook(video: VideoModel, registry: RegistryModel):
             'upload_session_id': session_id,
             'fields': 'id'
         }
-        if video.image_filename:
-            files = {
-                'thumb': open(video.image_filename, 'rb'),
-            }
-            result = requests.post(video_url, data=body, files=files)
-        else:
-            result = requests.post(video_url, data=body)
-        log_info('Facebook result: %s' % result.content)
-        if result.status_code == 200:
-            registry.target_platform_video_id = video_id
-            registry.set_state_and_persist('active')
-        else:
-            raise Exception('Invalid response: %s' % result.content)
+        try:
+            if video.image_filename:
+                files = {
+                    'thumb': open(video.image_filename, 'rb'),
+                }
+                result = session.post(video_url, data=body, files=files)
+            else:
+                result = session.post(video_url, data=body)
+            log_info('Facebook result: %s' % result.content)
+            if result.status_code != 200:
+                raise Exception('Invalid response: %s' % result.content)
+        except Exception:
+            if resumed:
+                # the resumed session may have expired meanwhile, so the next attempt starts a new one
+                log_warning('Registry: %s. Finishing resumed upload session %s failed, discarding it.' % (
+                    registry.registry_id, session_id))
+                registry.set_upload_session_and_persist(None)
+            raise
+        registry.target_platform_video_id = video_id
+        registry.upload_session = None
+        registry.set_state_and_persist('active')
 
     except Exception as e:
         raise Exception('Error uploading video of registry entry %s to facebook.' % registry.registry_id) from e
+    finally:
+        if file is not None:
+            file.close()
 
 
-def upload_chunk(retry_count, video_url, file, session_id, start_offset, end_offset, access_token, registry_id):
-    if retry_count > MAX_RETRY:
-        raise Exception(
-            'Registry: %s. Giving up uploading chunk with session_id: %s, start_offset: %s, end_offset: %s' % (
-            registry_id, session_id, start_offset, end_offset))
+def _open_video(video: VideoModel, registry: RegistryModel):
+    """ Opens the video to upload, either the downloaded file or the download stream of the video.
 
-    try:
-        file.seek(start_offset)
-        bytes_to_read = end_offset - start_offset
-        transfer_body = {
-            'access_token': access_token,
-            'upload_phase': 'transfer',
-            'upload_session_id': session_id,
-            'start_offset': start_offset,
-        }
-        transfer_file = {
-            'video_file_chunk': file.read(bytes_to_read)
-        }
-        transfer_result = requests.post(video_url, data=transfer_body, files=transfer_file, timeout=CHUNK_TIMEOUT)
-        if transfer_result.status_code == 200:
-            transfer_result_content = transfer_result.json()
-            new_start_offset = transfer_result_content['start_offset']
-            new_end_offset = transfer_result_content['end_offset']
-            return int(new_start_offset), int(new_end_offset)
+    :return: tuple of the file (or PipelinedDownload) and the size of the video
+    """
+    if _pipelined_upload(video):
+        log_info('Registry: %s. Streaming video from %s into upload.' % (registry.registry_id, video.download_url))
+        file = PipelinedDownload(video.download_url, PIPELINE_BUFFER_SIZE)
+        return file, file.size
+    return open(video.filename, 'rb'), os.path.getsize(video.filename)
+
+
+def _resumable_upload_session(registry: RegistryModel, file_size):
+    upload_session = registry.upload_session
+    if upload_session and upload_session.get('platform') == 'facebook' and upload_session.get('file_size') == file_size:
+        return upload_session
+    return None
+
+
+def _start_upload_session(video_url, file_size, access_token, registry: RegistryModel):
+    body = {
+        'access_token': access_token,
+        'upload_phase': 'start',
+        'file_size': file_size
+    }
+    start_result = session.post(video_url, data=body)
+
+    if start_result.status_code != 200:
+        raise Exception('Registry: %s. Error starting upload session %s' % (registry.registry_id, start_result.content))
+
+    log_debug('Registry %s. Start result: %s' % (registry.registry_id, start_result.content))
+    start_result_content = start_result.json()
+    upload_session = dict(
+        platform='facebook',
+        session_id=start_result_content['upload_session_id'],
+        video_id=start_result_content['video_id'],
+        start_offset=int(start_result_content['start_offset']),
+        end_offset=int(start_result_content['end_offset']),
+        file_size=file_size
+    )
+    log_info('Registry: %s. Upload session started with session_id: %s, start_offset: %s, end_offset: %s, file_size: %s' % (
+        registry.registry_id, upload_session['session_id'], upload_session['start_offset'], upload_session['end_offset'], file_size))
+    registry.set_upload_session_and_persist(upload_session)
+    return upload_session
+
+
+def _transfer_chunks(video_url, file, upload_session, access_token, registry: RegistryModel):
+    """
+    Upload the chunks requested by facebook until the whole file is transferred. The offsets acknowledged by facebook
+    are persisted with the registry entry after each chunk, so that the upload session can be resumed after a crash.
+
+    :return: the upload session after the last chunk
+    """
+    session_id = upload_session['session_id']
+    file_size = upload_session['file_size']
+    start_offset = upload_session['start_offset']
+    end_offset = upload_session['end_offset']
+    backoff = upload_retry_policy.start()
+    while end_offset > start_offset:
+        percent_uploaded = (start_offset / file_size) * 100
+        log_info('Registry: %s. Uploading chunk for session_id: %s, percent done: %d%%, start_offset: %s, end_offset: %s, file_size: %s' % (
+            registry.registry_id, session_id, percent_uploaded, start_offset, end_offset, file_size))
+        start_offset, end_offset = upload_chunk(video_url, file, session_id, start_offset, end_offset, access_token,
+                                                registry.registry_id, backoff)
+        upload_session = dict(upload_session, start_offset=start_offset, end_offset=end_offset)
+        registry.set_upload_session_and_persist(upload_session)
+    return upload_session
+
+
+class MultipartChunkBody(object):
+    """
+    Streaming multipart/form-data request body consisting of form fields and one file part. The file part is read
+    from the given file in blocks of at most CHUNK_BLOCK_SIZE while the request is sent, so that a chunk is never
+    held in memory as a whole.
+
+    :param fields: dict of form fields
+    :param name: name of the file field
+    :param file: file (or PipelinedDownload) to read the file part from
+    :param offset: offset of the file part in the file
+    :param length: length of the file part
+    """
+
+    def __init__(self, fields, name, file, offset, length):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        preamble = b''.join(
+            ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, key, value)).encode('UTF-8')
+            for key, value in fields.items())
+        preamble += ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name, name)).encode('UTF-8')
+        self._preamble = preamble
+        self._epilogue = ('\r\n--%s--\r\n' % boundary).encode('UTF-8')
+        self._file = file
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def __len__(self):
+        return len(self._preamble) + self._length + len(self._epilogue)
+
+    def __iter__(self):
+        block = self.read(CHUNK_BLOCK_SIZE)
+        while block:
+            yield block
+            block = self.read(CHUNK_BLOCK_SIZE)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > CHUNK_BLOCK_SIZE:
+            size = CHUNK_BLOCK_SIZE
+        file_start = len(self._preamble)
+        file_end = file_start + self._length
+        if self._position < file_start:
+            data = self._preamble[self._position:self._position + size]
+        elif self._position < file_end:
+            if self._position == file_start:
+                self._file.seek(self._offset)
+            data = self._file.read(min(size, file_end - self._position))
+            if not data:
+                raise IOError('Unexpected end of file at offset %s.' % (self._offset + self._position - file_start))
         else:
-            new_retry_count = retry_count + 1
-            log_warning('Registry: %s, Error uploading chunk. Retry: %s/%s. Response was %s' % (registry_id, new_retry_count, MAX_RETRY, transfer_result.content))
-            return upload_chunk(new_retry_count, video_url, file, session_id, start_offset, end_offset, access_token, registry_id)
-    except Exception as e:
-        new_retry_count = retry_count + 1
-        log_warning('Registry: %s, Error uploading chunk. Retry: %s/%s.' % (registry_id, new_retry_count, MAX_RETRY))
-        log_warning('Registry: %s, Exception: %s' % (registry_id, traceback.format_exc()))
-        time.sleep(CHUNK_ERROR_WAIT_SECONDS)
-        return upload_chunk(new_retry_count, video_url, file, session_id, start_offset, end_offset, access_token, registry_id)
+            data = self._epilogue[self._position - file_end:self._position - file_end + size]
+        self._position += len(data)
+        return data
+
+
+def _expired_session_error(result):
+    try:
+        error = result.json().get('error', {})
+    except ValueError:
+        return False
+    return error.get('error_subcode') in EXPIRED_SESSION_ERROR_SUBCODES
+
+
+def upload_chunk(video_url, file, session_id, start_offset, end_offset, access_token, registry_id, backoff=None):
+    """
+    Upload the chunk between start_offset and end_offset. Failed attempts are retried according to the upload retry
+    policy. The retry counter of the given backoff is reset once the chunk is transferred.
+
+    :param backoff: retry state shared by all chunks of the upload, a new one is started if not given
+    :return: the start and end offset of the next chunk requested by facebook
+    :raises UploadSessionExpiredException: if the upload session expired, such chunks are not retried
+    :raises DownloadError: if the chunk cannot be read from the streamed video, retrying would not help
+    """
+    if backoff is None:
+        backoff = upload_retry_policy.start()
+    while True:
+        try:
+            bytes_to_read = end_offset - start_offset
+            transfer_body = {
+                'access_token': access_token,
+                'upload_phase': 'transfer',
+                'upload_session_id': session_id,
+                'start_offset': start_offset,
+            }
+            body = MultipartChunkBody(transfer_body, 'video_file_chunk', file, start_offset, bytes_to_read)
+            transfer_result = session.post(video_url, data=body, headers={'Content-Type': body.content_type},
+                                           timeout=CHUNK_TIMEOUT)
+            if transfer_result.status_code == 200:
+                transfer_result_content = transfer_result.json()
+                new_start_offset = transfer_result_content['start_offset']
+                new_end_offset = transfer_result_content['end_offset']
+                backoff.reset()
+                return int(new_start_offset), int(new_end_offset)
+            if _expired_session_error(transfer_result):
+                raise UploadSessionExpiredException('Registry: %s. Upload session %s expired. Response was %s' % (
+                    registry_id, session_id, transfer_result.content))
+            reason = 'Response was %s' % transfer_result.content
+        except (UploadSessionExpiredException, DownloadError):
+            raise
+        except Exception as e:
+            log_warning('Registry: %s, Exception: %s' % (registry_id, traceback.format_exc()))
+            reason = 'Exception: %s' % e
+        log_warning('Registry: %s, Error uploading chunk. %s' % (registry_id, reason))
+        try:
+            backoff.wait(reason)
+        except RetryLimitExceededException as e:
+            raise Exception(
+                'Registry: %s. Giving up uploading chunk with session_id: %s, start_offset: %s, end_offset: %s' % (
+                    registry_id, session_id, start_offset, end_offset)) from e
 
 
 def upload_video_to_facebook_unchunked(video: VideoModel, registry: RegistryModel):
@@ -133,6 +383,7 @@ def upload_video_to_facebook_unchunked(video: VideoModel, registry: RegistryMode
 
     :param video: information about the video to upload
     :param registry: current status of processing
+    :raises SuccessWithWarningException: if the video was uploaded, but the captions could not be uploaded
 
     """
     if registry.target_platform_video_id or registry.intermediate_state != 'uploading':
@@ -158,9 +409,9 @@ def upload_video_to_facebook_unchunked(video: VideoModel, registry: RegistryMode
             files = {
                 'thumb': open(video.image_filename, 'rb'),
             }
-            result = requests.post(video_url, data=body, files=files)
+            result = session.post(video_url, data=body, files=files)
         else:
-            result = requests.post(video_url, data=body)
+            result = session.post(video_url, data=body)
 
         log_info('Facebook result: %s' % result.content)
 
@@ -168,15 +419,29 @@ def upload_video_to_facebook_unchunked(video: VideoModel, registry: RegistryMode
             facebook_video_id = result.json()['id']
             registry.target_platform_video_id = facebook_video_id
             registry.set_state_and_persist('active')
-            _upload_captions_if_exist(video, facebook_video_id, mapping, registry)
+            captions_uploaded, warning = _upload_captions_if_exist(video, facebook_video_id, mapping)
+            if captions_uploaded:
+                registry.set_captions_uploaded_and_persist(True)
+            if warning:
+                registry.message = warning
+                raise SuccessWithWarningException()
         else:
             raise Exception('Invalid response: %s' % result.content)
 
+    except SuccessWithWarningException:
+        raise
     except Exception as e:
         raise Exception('Error uploading video of registry entry %s to facebook.' % registry.registry_id) from e
 
 
-def _upload_captions_if_exist(video:VideoModel, facebook_video_id, mapping, registry:RegistryModel):
+def _upload_captions_if_exist(video:VideoModel, facebook_video_id, mapping):
+    """
+
+    Upload the captions of the video, if there are any. Runs on the media executor while the metadata is updated.
+
+    :return: tuple of whether captions were uploaded and the warning message if they could not be uploaded
+
+    """
     try:
         video_captions_url = API_URL + '%s/captions' % facebook_video_id
         if video.captions_filename:
@@ -189,17 +454,20 @@ def _upload_captions_if_exist(video:VideoModel, facebook_video_id, mapping, regi
             headers = {
                 'Authorization': 'OAuth %s' % str(mapping.target_id),
             }
-            result = requests.post(video_captions_url, data=body, files=files, headers=headers)
+            result = session.post(video_captions_url, data=body, files=files, headers=headers)
             if result.status_code == 200:
-                registry.set_captions_uploaded_and_persist(True)
                 log_info('Successfully uploaded captions for video %s' % video.video_id)
+                return True, None
             else:
                 raise Exception('Invalid response: %s' % result.content)
         else:
             log_info('No captions to upload for video %s' % video.video_id)
     except Exception as e:
-        log_warning('Error uploading captions for video %s. Error: %s' % (video.video_id, e))
+        message = 'Error uploading captions for video %s. Error: %s' % (video.video_id, e)
+        log_warning(message)
         log_warning(traceback.format_exc())
+        return False, message
+    return False, None
 
 
 def update_video_on_facebook(video: VideoModel, registry: RegistryModel):
@@ -208,6 +476,7 @@ def update_video_on_facebook(video: VideoModel, registry: RegistryModel):
 
     :param video: information about the video to upload
     :param registry: current status of processing
+    :raises SuccessWithWarningException: if the video was updated, but the captions could not be uploaded
 
     """
     if registry.target_platform_video_id is None or registry.intermediate_state != 'updating':
@@ -224,13 +493,24 @@ def update_video_on_facebook(video: VideoModel, registry: RegistryModel):
 
     mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
 
-    _upload_captions_if_exist(video, facebook_id, mapping, registry)
+    # captions are uploaded while the metadata is updated
+    captions = _media_executor.submit(_upload_captions_if_exist, video, facebook_id, mapping)
+    try:
+        _update_metadata_on_facebook(video, registry, mapping)
+    finally:
+        captions_uploaded, warning = captions.result()
+        if captions_uploaded:
+            registry.set_captions_uploaded_and_persist(True)
+    if warning:
+        registry.message = warning
+        raise SuccessWithWarningException()
 
+
+def _update_metadata_on_facebook(video: VideoModel, registry: RegistryModel, mapping):
     if video.hash_code == registry.video_hash_code:
         log_info('Metadata of registry entry %s not changed, so no update needed.' % registry.registry_id)
         return
 
-    mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
     try:
         get_metadata_url = API_URL + '/' + registry.target_platform_video_id + '?access_token=' + str(
             mapping.target_id) + '&fields=description,content_tags,title'
@@ -247,9 +527,9 @@ def update_video_on_facebook(video: VideoModel, registry: RegistryModel):
             files = {
                 'thumb': open(video.image_filename, 'rb'),
             }
-            result = requests.post(update_url, data=body, files=files)
+            result = session.post(update_url, data=body, files=files)
         else:
-            result = requests.post(update_url, data=body)
+            result = session.post(update_url, data=body)
 
         if result.status_code != 200:
             raise Exception('Invalid response: %s' % result.content)
@@ -280,7 +560,7 @@ def unpublish_video_on_facebook(video: VideoModel, registry: RegistryModel):
 
         update_url = API_URL + '/' + registry.target_platform_video_id
 
-        result = requests.post(update_url, body)
+        result = session.post(update_url, body)
 
         if result.status_code != 200:
             raise Exception('Invalid response: %s' % result.content)
@@ -289,6 +569,166 @@ def unpublish_video_on_facebook(video: VideoModel, registry: RegistryModel):
         raise Exception('Error unpublishing video of registry entry %s on facebook.' % registry.registry_id) from e
 
 
+def unpublish_videos_on_facebook(registries):
+    """
+
+    Unpublish the videos of many registry entries with Graph API batch requests. The operations are grouped by the
+    page token of the mapping of each entry.
+
+    :param registries: registry entries of the videos to unpublish
+    :return: dict mapping each registry id to None on success, otherwise to the error
+
+    """
+    return _batch_update_videos([(registry, {'expire_now': 'true'}) for registry in registries])
+
+
+def update_videos_on_facebook(videos_and_registries):
+    """
+
+    Batched variant of update_video_on_facebook. Title and description of the videos with changed metadata are
+    updated with Graph API batch requests (see update_videos_metadata_on_facebook). Thumbnails and captions are
+    still uploaded per video on the media executor while the batches are sent.
+
+    :param videos_and_registries: list of tuples of the video information and its registry entry
+    :return: dict mapping each registry id to None on success, to a SuccessWithWarningException if only thumbnail
+        or captions could not be uploaded, otherwise to the error
+
+    """
+    results = {}
+    media = []
+    changed = []
+    for video, registry in videos_and_registries:
+        if registry.target_platform_video_id is None or registry.intermediate_state != 'updating':
+            results[registry.registry_id] = Exception(
+                'Update not triggered because registry %s is not in correct state' % registry.registry_id)
+            continue
+        results[registry.registry_id] = None
+        if registry.captions_uploaded:
+            log_info('Captions already uploaded for video with id %s.' % registry.video_id)
+            continue
+        try:
+            mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
+        except Exception as e:
+            results[registry.registry_id] = e
+            continue
+
+        captions = _media_executor.submit(_upload_captions_if_exist, video, registry.target_platform_video_id, mapping)
+        thumbnail = None
+        if video.hash_code == registry.video_hash_code:
+            log_info('Metadata of registry entry %s not changed, so no update needed.' % registry.registry_id)
+        else:
+            changed.append((video, registry))
+            if video.image_filename:
+                thumbnail = _media_executor.submit(_upload_thumbnail, video, registry.target_platform_video_id, mapping)
+        media.append((registry, captions, thumbnail))
+
+    try:
+        results.update(update_videos_metadata_on_facebook(changed))
+    finally:
+        for registry, captions, thumbnail in media:
+            captions_uploaded, warning = captions.result()
+            if captions_uploaded:
+                registry.set_captions_uploaded_and_persist(True)
+            warnings = [warning for warning in (warning, thumbnail.result() if thumbnail else None) if warning]
+            if warnings and results[registry.registry_id] is None:
+                registry.message = ' '.join(warnings)
+                results[registry.registry_id] = SuccessWithWarningException()
+    return results
+
+
+def update_videos_metadata_on_facebook(videos_and_registries):
+    """
+
+    Update title and description of many videos with Graph API batch requests. Thumbnails and captions are not
+    part of the batch (see update_videos_on_facebook).
+
+    :param videos_and_registries: list of tuples of the video information and its registry entry
+    :return: dict mapping each registry id to None on success, otherwise to the error
+
+    """
+    return _batch_update_videos([(registry, {'name': video.title, 'description': video.description})
+                                 for video, registry in videos_and_registries])
+
+
+def _upload_thumbnail(video: VideoModel, facebook_video_id, mapping):
+    """
+
+    Upload the thumbnail of the video. Runs on the media executor.
+
+    :return: the warning message if the thumbnail could not be uploaded, otherwise None
+
+    """
+    try:
+        with open(video.image_filename, 'rb') as thumb:
+            result = session.post(API_URL + facebook_video_id, data={'access_token': str(mapping.target_id)},
+                                  files={'thumb': thumb})
+        if result.status_code != 200:
+            raise Exception('Invalid response: %s' % result.content)
+    except Exception as e:
+        message = 'Error uploading thumbnail for video %s. Error: %s' % (video.video_id, e)
+        log_warning(message)
+        log_warning(traceback.format_exc())
+        return message
+    return None
+
+
+def _batch_update_videos(operations):
+    results = {}
+    operations_by_page_token = {}
+    for registry, body in operations:
+        if not registry.target_platform_video_id:
+            results[registry.registry_id] = Exception('Facebook ID not found for %s.' % registry.registry_id)
+            continue
+        try:
+            mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
+        except Exception as e:
+            results[registry.registry_id] = e
+            continue
+        operations_by_page_token.setdefault(str(mapping.target_id), []).append((registry, body))
+
+    for access_token, page_operations in operations_by_page_token.items():
+        batch = [dict(method='POST', relative_url=registry.target_platform_video_id, body=urlencode(body))
+                 for registry, body in page_operations]
+        errors = execute_batch(access_token, batch)
+        for (registry, body), error in zip(page_operations, errors):
+            results[registry.registry_id] = error
+    log_info('Updated %s of %s videos on facebook in batches.' % (
+        len([error for error in results.values() if error is None]), len(results)))
+    return results
+
+
+def execute_batch(access_token, batch):
+    """
+
+    Send operations as Graph API batch requests of up to BATCH_SIZE operations each.
+
+    :param access_token: access token used for all operations
+    :param batch: list of operations, i.e. dicts with method, relative_url and optionally body
+    :return: list with None for every successful operation and the error otherwise, in the order of the operations
+
+    """
+    errors = []
+    for start in range(0, len(batch), BATCH_SIZE):
+        chunk = batch[start:start + BATCH_SIZE]
+        try:
+            result = session.post(API_URL, data={'access_token': access_token, 'batch': json.dumps(chunk)})
+            if result.status_code != 200:
+                raise Exception('Invalid response: %s' % result.content)
+            items = result.json()
+        except Exception as e:
+            errors.extend([e] * len(chunk))
+            continue
+        for operation, item in zip(chunk, items):
+            if item is None:
+                errors.append(Exception('No response for batch operation %s %s.' % (
+                    operation['method'], operation['relative_url'])))
+            elif item.get('code') != 200:
+                errors.append(Exception('Invalid response: %s' % item.get('body')))
+            else:
+                errors.append(None)
+    return errors
+
+
 def delete_video_on_facebook(video: VideoModel, registry: RegistryModel):
     """
 
@@ -1,78 +1,361 @@
 import traceback
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import partial
 
 from commonspy.logging import log_error, log_info
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 
-from connector import api
-from connector.db import RegistryModel
-from connector.states import Downloading, Updating, Unpublish, Deleting, Active
+from connector import api, config_property
+from connector.db import RegistryModel, MappingModel
+from connector.jobs import job_queue, QueueFullException, JobDeferredException
+from connector.platforms import PlatformInteraction
+from connector.states import Downloading, Updating, Unpublish, Deleting, Active, BulkUnpublish, BulkDeleting, \
+    BulkUpdating
+from connector.youtube import quota_ledger
+from connector.youtube_mcn import recover_pending_claims
+
+# Maximum number of registry entries handled by one batched job.
+BULK_JOB_SIZE = 50
+# Workflows deferred because of a low api quota are retried after this many seconds.
+QUOTA_DEFERRAL_SECONDS = 30 * 60
 
 
 def create_app():
     app = Flask(__name__)
     app.register_blueprint(api)
+    recover_workflows()
+    recover_pending_claims()
     return app
 
 
-@api.route('/update/<string:registry_id>')
-def update_request(registry_id):
-    log_info('Going to execute update / upload for registry id %s' % registry_id)
+def recover_workflows():
+    """ Schedules the workflows that did not finish before the last shutdown again, as the jobs of the
+    job queue (including deferred ones) are only kept in memory. The action is derived from the
+    intermediate state of the entry (see recovery_actions), new entries are updated, i.e. uploaded.
+    """
     try:
-        registry_model = RegistryModel.create_from_registry_id(registry_id)
-        if registry_model.status == 'notified':
-            log_info('New video detected. Starting upload workflow. registry id: %s' % registry_id)
-            Downloading.create_downloading_state(registry_model).run()
-        elif registry_model.status == 'active':
-            if registry_model.captions_uploaded:
-                # log_info('Captions already uploaded for video. Updating an existing video is currently not supported. Ignoring request. registry id: %s' % registry_id)
-                Updating.create_updating_state(registry_model).run()
-            else:
-                log_info('Captions will be uploaded for video if set in Kaltura. Existing video will be updated. registry id: %s' % registry_id)
-                Updating.create_updating_state(registry_model).run()
-        elif registry_model.status == 'inactive':
-            log_info('Detected inactive video. Activating it again. registry id: %s' % registry_id)
-            Active.create_active_state(registry_model).run()
-        elif registry_model.status == 'error':
-            log_info('Previous workflow ended with error. Retrying... registry id: %s' % registry_id)
-            if registry_model.intermediate_state == 'downloading' or registry_model.intermediate_state == 'uploading':
-                log_info('Retrying upload. registry id: %s' % registry_id)
-                Downloading.create_downloading_state(registry_model).run()
-            elif registry_model.intermediate_state == 'updating':
-                log_info('Retrying updating... registry id: %s' % registry_id)
-                Updating.create_updating_state(registry_model).run()
-            else:
-                log_info('No proper intermediate state found. Starting download... registry id: %s' % registry_id)
-                Downloading.create_downloading_state(registry_model).run()
+        registry_models = RegistryModel.find_unfinished()
     except Exception as e:
         log_error(traceback.format_tb(e.__traceback__))
-        traceback.print_tb(e.__traceback__)
-        return jsonify({'status': 'error'})
-    return jsonify({'status': 'success'})
+        log_error('Cannot load unfinished registry entries, no workflows recovered.')
+        return
+    registry_ids_by_action = OrderedDict()
+    for registry_id, registry_model in registry_models.items():
+        action = recovery_actions.get(registry_model.intermediate_state, 'update')
+        registry_ids_by_action.setdefault(action, []).append(registry_id)
+    for action, registry_ids in registry_ids_by_action.items():
+        results = {}
+        _submit_bulk_jobs(action, 'recover %s' % action, partial(run_workflows, action), registry_ids, results)
+        rejected = [registry_id for registry_id, result in results.items() if result['status'] == 'rejected']
+        log_info('Recovered %s of %s unfinished %s workflows.' % (
+            len(registry_ids) - len(rejected), len(registry_ids), action))
+        if rejected:
+            log_error('Job queue is full, cannot recover %s of registry ids %s.' % (action, ', '.join(rejected)))
+
+
+@api.route('/update/<string:registry_id>')
+def update_request(registry_id):
+    log_info('Going to enqueue update / upload for registry id %s' % registry_id)
+    return _enqueue_workflow('update', registry_id)
 
 
 @api.route('/unpublish/<string:registry_id>')
 def unpublish_request(registry_id):
-    log_info('Going to execute unpublish event for registry id %s.' % registry_id)
+    log_info('Going to enqueue unpublish event for registry id %s.' % registry_id)
+    return _enqueue_workflow('unpublish', registry_id)
+
+
+@api.route('/delete/<string:registry_id>')
+def delete_request(registry_id):
+    log_info('Going to enqueue deletion of video with registry id %s.' % registry_id)
+    return _enqueue_workflow('delete', registry_id)
+
+
+@api.route('/bulk/<string:action>', methods=['POST'])
+def bulk_request(action):
+    """ Schedules the workflow for the given action for all registry ids in the request body
+    (e.g. {"registry_ids": ["id1", "id2"]}). The registry entries are loaded with a single
+    query and the workflows are executed by the job queue workers.
+
+    Every job handles up to BULK_JOB_SIZE entries. If the target platform supports a batched
+    interaction for the action (see bulk_workflows), the entries are grouped by platform and
+    mapping and each job makes one batched platform request. Otherwise each job executes the
+    workflow for its entries one after the other (see run_workflows).
+
+    The jobs are bulk jobs, which are bounded by the bulk capacity of the job queue instead of
+    its queue size. The loaded entries are only used to schedule the jobs, every job loads its
+    entries again with a single query when it is executed. Only entries with a job in flight
+    are queued as single follow-up jobs, which load their entry on their own.
+    """
+    if action not in workflows:
+        return jsonify({'status': 'error', 'message': 'Unknown action %s.' % action}), 404
+    body = request.get_json(silent=True) or {}
+    registry_ids = body.get('registry_ids')
+    if not isinstance(registry_ids, list):
+        return jsonify({'status': 'error', 'message': 'Expected a list of registry_ids.'}), 400
+    log_info('Going to enqueue %s for %s registry ids.' % (action, len(registry_ids)))
     try:
-        registry_model = RegistryModel.create_from_registry_id(registry_id)
-        if registry_model.status == 'active' or registry_model.status == 'error':
-            log_info('Unpublishing video... registry id: %s' % registry_id)
-            Unpublish.create_unpublish_state(registry_model).run()
+        registry_models = RegistryModel.create_from_registry_ids(registry_ids)
     except Exception as e:
         log_error(traceback.format_tb(e.__traceback__))
         traceback.print_tb(e.__traceback__)
         return jsonify({'status': 'error'})
+
+    results = {}
+    single_ids = []
+    groups = OrderedDict()
+    interaction = PlatformInteraction()
+    for registry_id in registry_ids:
+        if registry_id not in registry_models:
+            results[registry_id] = {'status': 'not_found'}
+            continue
+        platform = registry_models[registry_id].target_platform
+        if action in bulk_workflows and interaction.supports(platform, 'bulk_%s' % action):
+            groups.setdefault((platform, registry_models[registry_id].mapping_id), []).append(registry_id)
+        else:
+            single_ids.append(registry_id)
+
+    for (platform, mapping_id), group_ids in groups.items():
+        _submit_bulk_jobs(action, 'bulk %s %s %s' % (action, platform, mapping_id),
+                          partial(run_bulk_workflow, action, platform), group_ids, results)
+    _submit_bulk_jobs(action, 'bulk %s' % action, partial(run_workflows, action), single_ids, results)
+    return jsonify({'status': 'accepted', 'results': results}), 202
+
+
+def _submit_bulk_jobs(action, name, target, registry_ids, results):
+    """ Submits batch jobs for chunks of up to BULK_JOB_SIZE registry ids. Entries with a job in
+    flight are queued as single follow-up jobs instead. The outcome per id is added to results.
+    """
+    for start in range(0, len(registry_ids), BULK_JOB_SIZE):
+        chunk = registry_ids[start:start + BULK_JOB_SIZE]
+        try:
+            job, in_flight = job_queue.submit_batch(name, target, chunk)
+        except QueueFullException:
+            for registry_id in chunk:
+                results[registry_id] = {'status': 'rejected'}
+            continue
+        for registry_id in chunk:
+            if registry_id not in in_flight:
+                results[registry_id] = {'status': 'accepted', 'job_id': job.job_id}
+        for registry_id in in_flight:
+            try:
+                follow_up = job_queue.submit('%s %s' % (action, registry_id),
+                                             partial(run_workflow, action, registry_id), key=registry_id, bulk=True)
+                results[registry_id] = {'status': 'accepted', 'job_id': follow_up.job_id}
+            except QueueFullException:
+                results[registry_id] = {'status': 'rejected'}
+
+
+@api.route('/jobs/<string:job_id>')
+def job_request(job_id):
+    job = job_queue.job(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Job %s not found.' % job_id}), 404
+    return jsonify(job.to_dict())
+
+
+@api.route('/mappings/<string:mapping_id>/invalidate')
+def invalidate_mapping_request(mapping_id):
+    log_info('Invalidating cached mapping with id %s.' % mapping_id)
+    MappingModel.invalidate_cache(mapping_id)
     return jsonify({'status': 'success'})
 
 
-@api.route('/delete/<string:registry_id>')
-def delete_request(registry_id):
-    log_info('Going to delete video with registry id %s.' % registry_id)
+@api.route('/metrics/youtube_quota')
+def youtube_quota_request():
+    """ Returns the estimated youtube api quota used and remaining today per project. """
+    try:
+        return jsonify({'status': 'success', 'projects': quota_ledger.usage()})
+    except Exception as e:
+        log_error(traceback.format_tb(e.__traceback__))
+        return jsonify({'status': 'error'}), 503
+
+
+def _enqueue_workflow(action, registry_id):
     try:
-        registry_model = RegistryModel.create_from_registry_id(registry_id)
-        Deleting.create_deleting_state(registry_model).run()
+        job = job_queue.submit('%s %s' % (action, registry_id), partial(run_workflow, action, registry_id),
+                               key=registry_id)
     except Exception as e:
         log_error(traceback.format_tb(e.__traceback__))
         traceback.print_tb(e.__traceback__)
-        return jsonify({'status': 'error'})
-    return jsonify({'status': 'success'})
+        return jsonify({'status': 'error'}), 503
+    return jsonify({'status': 'accepted', 'job_id': job.job_id}), 202
+
+
+def run_workflow(action, registry_id):
+    """ Executes the workflow for the given action. Called by the job queue workers.
+
+    Changes of the registry entry are collected and written at the transitions between the
+    states (see RegistryModel.deferred_persist).
+
+    If the api quota of the target platform runs low, the workflow is deferred depending on its
+    priority (see workflow_priority) and executed again later.
+    """
+    _run_workflow(action, RegistryModel.create_from_registry_id(registry_id))
+
+
+def run_workflows(action, registry_ids):
+    """ Executes the workflow for the given action for several registry entries one after the other.
+    The entries are loaded with a single query. Called by the job queue workers, see bulk_request.
+
+    A failing entry does not stop the others. Entries deferred because of a low api quota are
+    deferred together (see run_workflow).
+    """
+    registry_models = RegistryModel.create_from_registry_ids(registry_ids)
+    deferred_ids = []
+    failed_ids = []
+    for registry_id in registry_ids:
+        if registry_id not in registry_models:
+            log_info('Registry entry %s not found, skipping %s.' % (registry_id, action))
+            continue
+        try:
+            _run_workflow(action, registry_models[registry_id])
+        except JobDeferredException as e:
+            log_info(str(e))
+            deferred_ids.append(registry_id)
+        except Exception as e:
+            log_error(traceback.format_exc())
+            log_error('Workflow %s of registry id %s failed. %s' % (action, registry_id, e))
+            failed_ids.append(registry_id)
+    if deferred_ids:
+        raise JobDeferredException('Api quota is running low, deferring %s of %s registry ids.' % (
+            action, len(deferred_ids)), partial(run_workflows, action),
+            int(config_property('youtube_quota.deferral_seconds', QUOTA_DEFERRAL_SECONDS)), keys=deferred_ids)
+    if failed_ids:
+        raise Exception('Workflow %s failed for registry ids %s.' % (action, ', '.join(failed_ids)))
+
+
+def _run_workflow(action, registry_model):
+    registry_id = registry_model.registry_id
+    priority = workflow_priority(action, registry_model)
+    if not PlatformInteraction().quota_available(registry_model.target_platform, priority):
+        raise JobDeferredException('Api quota of %s is running low, deferring %s of registry id %s (priority %s).' % (
+            registry_model.target_platform, action, registry_id, priority), partial(run_workflow, action, registry_id),
+            int(config_property('youtube_quota.deferral_seconds', QUOTA_DEFERRAL_SECONDS)))
+    with registry_model.deferred_persist():
+        workflows[action](registry_model)
+
+
+def workflow_priority(action, registry_model):
+    """ Unpublishing and deleting have a high priority and are never deferred. Updates of already
+    published videos have a low priority and are deferred first if the api quota runs low.
+    """
+    if action in ('unpublish', 'delete'):
+        return 'high'
+    if registry_model.status == 'active':
+        return 'low'
+    return 'normal'
+
+
+def run_bulk_workflow(action, platform, registry_ids):
+    """ Executes the batched workflow for the given action for the registry entries with the given
+    ids. Called by the job queue workers, see bulk_request.
+
+    Entries whose workflow priority does not fit the api quota of the platform are deferred together
+    (see run_workflow).
+    """
+    registry_models = RegistryModel.create_from_registry_ids(registry_ids)
+    selected = []
+    deferred_ids = []
+    interaction = PlatformInteraction()
+    for registry_id in registry_ids:
+        if registry_id not in registry_models:
+            continue
+        if interaction.quota_available(platform, workflow_priority(action, registry_models[registry_id])):
+            selected.append(registry_models[registry_id])
+        else:
+            deferred_ids.append(registry_id)
+    if selected:
+        with ExitStack() as stack:
+            for registry_model in selected:
+                stack.enter_context(registry_model.deferred_persist())
+            bulk_workflows[action](selected, platform)
+    if deferred_ids:
+        raise JobDeferredException('Api quota of %s is running low, deferring %s of %s registry ids.' % (
+            platform, action, len(deferred_ids)), partial(run_bulk_workflow, action, platform),
+            int(config_property('youtube_quota.deferral_seconds', QUOTA_DEFERRAL_SECONDS)), keys=deferred_ids)
+
+
+def update_workflow(registry_model):
+    registry_id = registry_model.registry_id
+    if registry_model.status == 'notified':
+        log_info('New video detected. Starting upload workflow. registry id: %s' % registry_id)
+        Downloading.create_downloading_state(registry_model).run()
+    elif registry_model.status == 'active':
+        if registry_model.captions_uploaded:
+            # log_info('Captions already uploaded for video. Updating an existing video is currently not supported. Ignoring request. registry id: %s' % registry_id)
+            Updating.create_updating_state(registry_model).run()
+        else:
+            log_info('Captions will be uploaded for video if set in Kaltura. Existing video will be updated. registry id: %s' % registry_id)
+            Updating.create_updating_state(registry_model).run()
+    elif registry_model.status == 'inactive':
+        log_info('Detected inactive video. Activating it again. registry id: %s' % registry_id)
+        Active.create_active_state(registry_model).run()
+    elif registry_model.status == 'error':
+        log_info('Previous workflow ended with error. Retrying... registry id: %s' % registry_id)
+        if registry_model.intermediate_state == 'downloading' or registry_model.intermediate_state == 'uploading':
+            log_info('Retrying upload. registry id: %s' % registry_id)
+            Downloading.create_downloading_state(registry_model).run()
+        elif registry_model.intermediate_state == 'updating':
+            log_info('Retrying updating... registry id: %s' % registry_id)
+            Updating.create_updating_state(registry_model).run()
+        else:
+            log_info('No proper intermediate state found. Starting download... registry id: %s' % registry_id)
+            Downloading.create_downloading_state(registry_model).run()
+
+
+def unpublish_workflow(registry_model):
+    if registry_model.status == 'active' or registry_model.status == 'error':
+        log_info('Unpublishing video... registry id: %s' % registry_model.registry_id)
+        Unpublish.create_unpublish_state(registry_model).run()
+
+
+def delete_workflow(registry_model):
+    log_info('Deleting video... registry id: %s' % registry_model.registry_id)
+    Deleting.create_deleting_state(registry_model).run()
+
+
+def bulk_update_workflow(registry_models, platform):
+    """ Active entries are updated together with a batched platform interaction, all others run
+    the update workflow one after the other (see update_workflow). """
+    active = [registry_model for registry_model in registry_models if registry_model.status == 'active']
+    others = [registry_model for registry_model in registry_models if registry_model.status != 'active']
+    if active:
+        log_info('Updating %s videos on %s...' % (len(active), platform))
+        BulkUpdating.create_bulk_updating_state(active, platform).run()
+    for registry_model in others:
+        update_workflow(registry_model)
+
+
+def bulk_unpublish_workflow(registry_models, platform):
+    eligible = [registry_model for registry_model in registry_models
+                if registry_model.status == 'active' or registry_model.status == 'error']
+    if eligible:
+        log_info('Unpublishing %s videos on %s...' % (len(eligible), platform))
+        BulkUnpublish.create_bulk_unpublish_state(eligible, platform).run()
+
+
+def bulk_delete_workflow(registry_models, platform):
+    log_info('Deleting %s videos on %s...' % (len(registry_models), platform))
+    BulkDeleting.create_bulk_deleting_state(registry_models, platform).run()
+
+
+workflows = {
+    'update': update_workflow,
+    'unpublish': unpublish_workflow,
+    'delete': delete_workflow
+}
+
+# Workflows interrupted in one of these intermediate states are recovered with the given action, all others
+# with 'update'.
+recovery_actions = {
+    'unpublishing': 'unpublish',
+    'deleting': 'delete'
+}
+
+bulk_workflows = {
+    'update': bulk_update_workflow,
+    'unpublish': bulk_unpublish_workflow,
+    'delete': bulk_delete_workflow
+}
@@ -0,0 +1,240 @@
+import queue
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from functools import partial
+
+from commonspy.logging import log_error, log_info, log_debug
+
+from connector import config_property
+
+""" This module provides the job queue used to decouple the
+http endpoints from the actual (long running) workflows.
+Jobs are drained by a bounded pool of worker threads.
+"""
+DEFAULT_WORKER_COUNT = 4
+DEFAULT_QUEUE_SIZE = 1000
+# Bulk jobs (see submit) are bounded separately, so that a bulk request neither fills the queue for
+# single requests nor is rejected by it.
+DEFAULT_BULK_QUEUE_SIZE = 50000
+
+# Number of jobs kept in memory, so that their status can be queried.
+MAX_REMEMBERED_JOBS = 5000
+
+
+class QueueFullException(Exception):
+    """ Raised if a job cannot be enqueued because the job queue reached its capacity. """
+
+
+class JobDeferredException(Exception):
+    """ Raised by a job target to postpone the work. The given target is submitted again
+    with the same name and key after delay seconds. If keys are given, the target is submitted
+    as batch job for these keys instead (see JobQueue.submit_batch).
+    """
+
+    def __init__(self, message, target, delay, keys=None):
+        super().__init__(message)
+        self.target = target
+        self.delay = delay
+        self.keys = keys
+
+
+class Job(object):
+    def __init__(self, name, target, key=None, keys=None, bulk=False):
+        self.job_id = str(uuid.uuid4())
+        self.name = name
+        self.target = target
+        self.key = key
+        self.keys = keys if keys is not None else ([key] if key is not None else [])
+        self.bulk = bulk
+        self.status = 'queued'
+        self.error = None
+
+    def to_dict(self):
+        return dict(
+            job_id=self.job_id,
+            name=self.name,
+            status=self.status,
+            error=self.error
+        )
+
+
+class JobQueue(object):
+    def __init__(self, worker_count, queue_size, name='connector-worker', bulk_queue_size=0):
+        self.worker_count = worker_count
+        self.queue_size = queue_size
+        self.bulk_queue_size = bulk_queue_size
+        self.name = name
+        self._queue = queue.Queue()
+        self._queued_bulk = 0
+        self._jobs = OrderedDict()
+        self._in_flight = {}
+        self._follow_ups = {}
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(self, name, target, key=None, bulk=False):
+        """ Enqueues the given callable and returns the created job. The job is executed
+        asynchronously by one of the workers.
+
+        Jobs sharing the same key are never executed in parallel. If a job with the same
+        name is already waiting for the key, the request is folded into that job and the
+        waiting job is returned instead. If the job for the key is already running, at most
+        one follow-up job per name is queued and executed once the running job is done.
+
+        :param name: human readable name of the job
+        :param target: callable without arguments executing the actual work
+        :param key: optional key identifying the resource the job works on
+        :param bulk: whether the job is part of a bulk request, bulk jobs are bounded by bulk_queue_size
+        :return: the enqueued (or coalesced) job
+        """
+        self._start_workers()
+        with self._lock:
+            if key is not None and key in self._in_flight:
+                return self._coalesce(name, target, key, bulk)
+            self._check_capacity(name, bulk)
+            job = Job(name, target, key, bulk=bulk)
+            if key is not None:
+                self._in_flight[key] = job
+            self._put(job)
+            self._remember(job)
+        log_debug('Enqueued job %s with id %s.' % (name, job.job_id))
+        return job
+
+    def submit_batch(self, name, target, keys):
+        """ Enqueues one bulk job working on several keys at once (e.g. a batched platform request for
+        many registry entries). Keys of jobs already in flight are left out, so that jobs sharing a
+        key are still never executed in parallel. The batch job itself blocks its keys: jobs submitted
+        for them while it is in flight are queued as follow-ups.
+
+        :param name: human readable name of the job
+        :param target: callable receiving the list of accepted keys
+        :param keys: keys the job works on
+        :return: the enqueued job (None if no key was accepted) and the list of keys left out
+        """
+        self._start_workers()
+        keys = list(OrderedDict.fromkeys(keys))
+        with self._lock:
+            accepted = [key for key in keys if key not in self._in_flight]
+            rejected = [key for key in keys if key in self._in_flight]
+            if not accepted:
+                return None, rejected
+            self._check_capacity(name, True)
+            job = Job(name, partial(target, accepted), keys=accepted, bulk=True)
+            for key in accepted:
+                self._in_flight[key] = job
+            self._put(job)
+            self._remember(job)
+        log_debug('Enqueued job %s with id %s for %s keys.' % (name, job.job_id, len(accepted)))
+        return job, rejected
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _check_capacity(self, name, bulk):
+        if bulk and self._queued_bulk >= self.bulk_queue_size:
+            raise QueueFullException('Cannot enqueue bulk job %s, job queue is full.' % name)
+        if not bulk and self._queue.qsize() - self._queued_bulk >= self.queue_size:
+            raise QueueFullException('Cannot enqueue job %s, job queue is full.' % name)
+
+    def _put(self, job):
+        if job.bulk:
+            self._queued_bulk += 1
+        self._queue.put_nowait(job)
+
+    def _coalesce(self, name, target, key, bulk):
+        active = self._in_flight[key]
+        if active.status == 'queued' and active.name == name:
+            log_info('Folding job %s into queued job %s.' % (name, active.job_id))
+            return active
+        follow_ups = self._follow_ups.setdefault(key, [])
+        for follow_up in follow_ups:
+            if follow_up.name == name:
+                log_info('Folding job %s into follow-up job %s.' % (name, follow_up.job_id))
+                return follow_up
+        job = Job(name, target, key, bulk=bulk)
+        follow_ups.append(job)
+        self._remember(job)
+        log_info('Job %s is already in flight, queued follow-up job %s.' % (name, job.job_id))
+        return job
+
+    def _release(self, job):
+        with self._lock:
+            for key in job.keys:
+                follow_ups = self._follow_ups.get(key)
+                if follow_ups:
+                    next_job = follow_ups.pop(0)
+                    if not follow_ups:
+                        del self._follow_ups[key]
+                    self._in_flight[key] = next_job
+                    self._put(next_job)
+                else:
+                    del self._in_flight[key]
+
+    def _resubmit(self, job, deferral):
+        try:
+            if deferral.keys is None:
+                self.submit(job.name, deferral.target, key=job.key, bulk=job.bulk)
+                return
+            _, in_flight = self.submit_batch(job.name, deferral.target, deferral.keys)
+            for key in in_flight:
+                self.submit(job.name, partial(deferral.target, [key]), key=key, bulk=True)
+        except QueueFullException:
+            log_error('Cannot resubmit deferred job %s with id %s, job queue is full.' % (job.name, job.job_id))
+
+    def _remember(self, job):
+        self._jobs[job.job_id] = job
+        if len(self._jobs) > MAX_REMEMBERED_JOBS:
+            done = [job_id for job_id, known in self._jobs.items() if known.status in ('finished', 'failed', 'deferred')]
+            for job_id in done[:len(self._jobs) - MAX_REMEMBERED_JOBS]:
+                del self._jobs[job_id]
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.worker_count:
+                worker = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self._workers)))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job.bulk:
+                with self._lock:
+                    self._queued_bulk -= 1
+            try:
+                self._run(job)
+            finally:
+                if job.keys:
+                    self._release(job)
+                self._queue.task_done()
+
+    def _run(self, job):
+        log_info('Starting job %s with id %s.' % (job.name, job.job_id))
+        with self._lock:
+            job.status = 'running'
+        try:
+            job.target()
+            job.status = 'finished'
+            log_info('Finished job %s with id %s.' % (job.name, job.job_id))
+        except JobDeferredException as e:
+            log_info('Deferring job %s with id %s for %s seconds. %s' % (job.name, job.job_id, e.delay, e))
+            job.status = 'deferred'
+            job.error = str(e)
+            timer = threading.Timer(e.delay, self._resubmit, (job, e))
+            timer.daemon = True
+            timer.start()
+        except Exception as e:
+            traceback.print_exc()
+            log_error(traceback.format_exc())
+            log_error('Job %s with id %s failed.' % (job.name, job.job_id))
+            job.status = 'failed'
+            job.error = str(e)
+
+
+job_queue = JobQueue(int(config_property('jobs.worker_count', DEFAULT_WORKER_COUNT)),
+                     int(config_property('jobs.queue_size', DEFAULT_QUEUE_SIZE)),
+                     bulk_queue_size=int(config_property('jobs.bulk_queue_size', DEFAULT_BULK_QUEUE_SIZE)))
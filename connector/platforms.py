@@ -4,11 +4,14 @@ from commonspy.logging import log_info
 
 from connector import config
 from connector.facebook import upload_video_to_facebook, update_video_on_facebook, unpublish_video_on_facebook, \
-    delete_video_on_facebook
+    delete_video_on_facebook, video_binary_required_for_facebook, update_videos_on_facebook, \
+    unpublish_videos_on_facebook
 from connector.youtube_mcn import upload_video_to_youtube_mcn, delete_video_on_youtube_mcn, unpublish_video_on_youtube_mcn, \
-    update_video_on_youtube_mcn
+    update_video_on_youtube_mcn, update_videos_on_youtube_mcn, unpublish_videos_on_youtube_mcn, \
+    quota_available_for_youtube_mcn
 from connector.youtube_direct import upload_video_to_youtube_direct, delete_video_on_youtube_direct, \
-    unpublish_video_on_youtube_direct, update_video_on_youtube_direct
+    unpublish_video_on_youtube_direct, update_video_on_youtube_direct, update_videos_on_youtube_direct, \
+    unpublish_videos_on_youtube_direct, quota_available_for_youtube_direct
 
 
 def test_mode_action(action, video, registry):
@@ -19,19 +22,31 @@ registered_platforms = {
                 'upload': upload_video_to_facebook,
                 'update': update_video_on_facebook,
                 'unpublish': unpublish_video_on_facebook,
-                'delete': delete_video_on_facebook
+                'delete': delete_video_on_facebook,
+                'bulk_update': update_videos_on_facebook,
+                'bulk_unpublish': unpublish_videos_on_facebook,
+                'bulk_delete': unpublish_videos_on_facebook,
+                'binary_required': video_binary_required_for_facebook
             },
             'youtube': {
                 'upload': upload_video_to_youtube_mcn,
                 'update': update_video_on_youtube_mcn,
                 'unpublish': unpublish_video_on_youtube_mcn,
-                'delete': delete_video_on_youtube_mcn
+                'delete': delete_video_on_youtube_mcn,
+                'bulk_update': update_videos_on_youtube_mcn,
+                'bulk_unpublish': unpublish_videos_on_youtube_mcn,
+                'bulk_delete': unpublish_videos_on_youtube_mcn,
+                'quota_available': quota_available_for_youtube_mcn
             },
             'youtube_direct': {
                 'upload': upload_video_to_youtube_direct,
                 'update': update_video_on_youtube_direct,
                 'unpublish': unpublish_video_on_youtube_direct,
-                'delete': delete_video_on_youtube_direct
+                'delete': delete_video_on_youtube_direct,
+                'bulk_update': update_videos_on_youtube_direct,
+                'bulk_unpublish': unpublish_videos_on_youtube_direct,
+                'bulk_delete': unpublish_videos_on_youtube_direct,
+                'quota_available': quota_available_for_youtube_direct
             }
         }
 
@@ -68,3 +83,28 @@ class PlatformInteraction(object):
             self.registered_platforms[platform][interaction](video, registry_model)
         else:
             raise Exception('Target platform %s with interaction %s does not exist!')
+
+    def supports(self, platform, interaction):
+        return interaction in self.registered_platforms.get(platform, {})
+
+    def execute_bulk_platform_interaction(self, platform, interaction, registry_models):
+        """ Executes a batched interaction (e.g. 'bulk_unpublish') for many registry entries at once.
+
+        :param registry_models: the registry entries, for 'bulk_update' tuples of video and registry entry
+        :return: dict mapping each registry id to None on success, otherwise to the error
+        """
+        if not self.supports(platform, interaction):
+            raise Exception('Target platform %s with interaction %s does not exist!' % (platform, interaction))
+        return self.registered_platforms[platform][interaction](registry_models)
+
+    def quota_available(self, platform, priority):
+        """ Checks whether work of the given priority ('high', 'normal' or 'low') should be started now with
+        respect to the api quota of the platform. Platforms with a quota register a 'quota_available' check. """
+        check = self.registered_platforms.get(platform, {}).get('quota_available')
+        return check(priority) if check else True
+
+    def binary_required(self, platform, video):
+        """ Checks whether the upload to the platform needs the video binary on disk. Platforms that stream the
+        binary themselves register a 'binary_required' check. """
+        check = self.registered_platforms.get(platform, {}).get('binary_required')
+        return check(video) if check else True
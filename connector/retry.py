@@ -0,0 +1,77 @@
+import random
+import time
+
+from commonspy.logging import log_info
+
+from connector import config_property
+
+""" This module provides the retry policy shared by the
+platform uploads, so that all platforms back off the same
+way if they are degraded.
+"""
+DEFAULT_MAX_RETRIES = 10
+DEFAULT_BASE_DELAY = 2
+DEFAULT_MAX_DELAY = 120
+# Maximum time in seconds an operation spends waiting for retries in total.
+DEFAULT_TIME_BUDGET = 1800
+
+
+class RetryLimitExceededException(Exception):
+    """ Raised if an operation should not be retried any more. """
+
+
+class RetryPolicy(object):
+    """ Exponential backoff with full jitter. The n-th retry waits a random time between 0 and
+    min(max_delay, base_delay * 2 ^ (n - 1)) seconds. An operation is given up after max_retries
+    consecutive retries or if its total waiting time would exceed time_budget seconds.
+    """
+
+    def __init__(self, max_retries, base_delay, max_delay, time_budget, sleep=time.sleep, rand=random.random):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.time_budget = time_budget
+        self.sleep = sleep
+        self.rand = rand
+
+    def start(self):
+        """ Creates the backoff state for a new operation. """
+        return Backoff(self)
+
+
+class Backoff(object):
+    """ Retry state of a single operation. The retry counter can be reset (e.g. after each successfully
+    transferred chunk of an upload), the time budget spans the whole operation.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.retries = 0
+        self.waited = 0
+
+    def reset(self):
+        self.retries = 0
+
+    def wait(self, reason):
+        """ Waits before the next retry.
+
+        :param reason: description of the error causing the retry, used for logging
+        :raise RetryLimitExceededException: if the operation should be given up
+        """
+        policy = self.policy
+        self.retries += 1
+        if self.retries > policy.max_retries:
+            raise RetryLimitExceededException('Giving up after %s retries. %s' % (policy.max_retries, reason))
+        delay = policy.rand() * min(policy.max_delay, policy.base_delay * 2 ** (self.retries - 1))
+        if self.waited + delay > policy.time_budget:
+            raise RetryLimitExceededException('Giving up, retry time budget of %s seconds exhausted. %s' % (
+                policy.time_budget, reason))
+        log_info('Retry %s/%s in %.1f seconds. %s' % (self.retries, policy.max_retries, delay, reason))
+        policy.sleep(delay)
+        self.waited += delay
+
+
+upload_retry_policy = RetryPolicy(int(config_property('upload_retry.max_retries', DEFAULT_MAX_RETRIES)),
+                                  float(config_property('upload_retry.base_delay', DEFAULT_BASE_DELAY)),
+                                  float(config_property('upload_retry.max_delay', DEFAULT_MAX_DELAY)),
+                                  float(config_property('upload_retry.time_budget', DEFAULT_TIME_BUDGET)))
@@ -1,10 +1,12 @@
 import os
 import traceback
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 from commonspy.logging import log_error, log_info, log_debug, build_message_from_exception_chain
 
 from connector.db import VideoModel, persist_video_image_on_disk
+from connector.download import download_file
 from connector.platforms import PlatformInteraction
 from connector.youtube import SuccessWithWarningException
 
@@ -32,10 +34,11 @@ class Downloading(object):
         self.error_state = Error.create_error_state(registry_model)
         self.next_state = Uploading.create_uploading_state(registry_model)
         self.registry_model = registry_model
-        self.download_binary_from_kaltura_to_disk = urllib.request.urlretrieve
+        self.download_binary_from_kaltura_to_disk = download_file
         self.video_model_class = VideoModel
         self.image_download = persist_video_image_on_disk
         self.captions_download = download_captions
+        self.interaction = PlatformInteraction()
 
     def _next_state(self, video):
         self.next_state.run(video)
@@ -54,14 +57,31 @@ class Downloading(object):
             log_error('Cannot download binary with url %s.' % download_url)
             raise Exception('Cannot download binary with url %s.' % download_url) from e
 
+    def _download_files(self, video_model):
+        """ Fetches the video binary, the thumbnail and the captions concurrently. The video binary is skipped if
+        the target platform streams it during the upload. """
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(self.image_download, video_model),
+                executor.submit(self.captions_download, video_model)
+            ]
+            if self.interaction.binary_required(self.registry_model.target_platform, video_model):
+                futures.append(executor.submit(self._download_binaries, video_model.download_url, video_model.filename))
+            else:
+                log_info('Video binary of registry id %s is streamed during upload, skipping download.' % (
+                    self.registry_model.registry_id))
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise Exception('Cannot download %s of %s files of video %s. %s' % (
+                len(errors), len(futures), video_model.video_id,
+                ' '.join(build_message_from_exception_chain(error) for error in errors))) from errors[0]
+
     def run(self):
         try:
             log_debug('Entering downloading state for registry id %s.' % self.registry_model.registry_id)
             self.registry_model.set_intermediate_state_and_persist('downloading')
             video_model = self.video_model_class.create_from_video_id(self.registry_model.video_id)
-            self._download_binaries(video_model.download_url, video_model.filename)
-            self.image_download(video_model)
-            self.captions_download(video_model)
+            self._download_files(video_model)
             self.registry_model.update_video_hash_code(video_model.hash_code)
             log_debug('Download of video with registry id %s successful.' % self.registry_model.registry_id)
             self._next_state(video_model)
@@ -189,6 +209,7 @@ class Updating(object):
         self.registry_model = registry_model
         self.interaction = PlatformInteraction()
         self.next_state = Active.create_active_state(self.registry_model)
+        self.next_state_with_custom_message = Active.create_active_state(self.registry_model, False)
         self.error_state = Error.create_error_state(registry_model)
         self.video_model_class = VideoModel
         self.captions_download = download_captions
@@ -209,6 +230,10 @@ class Updating(object):
             log_debug('Finished update state for video with registry id %s and platform %s' % (
                 self.registry_model.registry_id, self.registry_model.target_platform))
             self.next_state.run(video_model)
+        except SuccessWithWarningException:
+            log_debug('Finished update state for video with registry id %s and platform %s' % (
+                self.registry_model.registry_id, self.registry_model.target_platform))
+            self.next_state_with_custom_message.run(video_model)
         except Exception as e:
             traceback.print_exc()
             log_error(traceback.format_exc())
@@ -370,3 +395,139 @@ class Deleted(object):
     @classmethod
     def create_deleted_state(cls, registry_model):
         return cls(registry_model)
+
+
+class BulkUnpublish(object):
+    """ Unpublishes many registry entries of the same platform (and mapping) with one batched platform
+    interaction. Every entry moves on to its next state or to the error state on its own. """
+    interaction_name = 'bulk_unpublish'
+    intermediate_state = 'unpublishing'
+
+    def __init__(self, registry_models, platform):
+        self.registry_models = registry_models
+        self.platform = platform
+        self.interaction = PlatformInteraction()
+
+    def _next_state(self, registry_model):
+        return Inactive.create_inactive_state(registry_model)
+
+    def _fire_error(self, registry_model, message):
+        log_error(message)
+        registry_model.message = message
+        Error.create_error_state(registry_model).run()
+
+    def run(self):
+        log_debug('Entering %s state for %s registry entries and platform %s' % (
+            self.interaction_name, len(self.registry_models), self.platform))
+        registry_models = []
+        for registry_model in self.registry_models:
+            try:
+                registry_model.set_intermediate_state_and_persist(self.intermediate_state)
+                registry_models.append(registry_model)
+            except Exception as e:
+                log_error(traceback.format_exc())
+                self._fire_error(registry_model, 'Cannot set intermediate state of registry id %s. %s' % (
+                    registry_model.registry_id, build_message_from_exception_chain(e)))
+        if not registry_models:
+            return
+
+        try:
+            results = self.interaction.execute_bulk_platform_interaction(self.platform, self.interaction_name,
+                                                                         registry_models)
+        except Exception as e:
+            traceback.print_exc()
+            log_error(traceback.format_exc())
+            results = dict((registry_model.registry_id, e) for registry_model in registry_models)
+
+        for registry_model in registry_models:
+            registry_id = registry_model.registry_id
+            error = results.get(registry_id, Exception('No result for registry id %s.' % registry_id))
+            if error is None:
+                self._next_state(registry_model).run()
+            else:
+                self._fire_error(registry_model, 'Cannot perform %s of video with id %s and registry id %s. %s' % (
+                    self.interaction_name, registry_model.video_id, registry_id,
+                    build_message_from_exception_chain(error)))
+        log_debug('Finished %s state for %s registry entries and platform %s' % (
+            self.interaction_name, len(registry_models), self.platform))
+
+    @classmethod
+    def create_bulk_unpublish_state(cls, registry_models, platform):
+        return cls(registry_models, platform)
+
+
+class BulkDeleting(BulkUnpublish):
+    interaction_name = 'bulk_delete'
+    intermediate_state = 'deleting'
+
+    def _next_state(self, registry_model):
+        return Deleted.create_deleted_state(registry_model)
+
+    @classmethod
+    def create_bulk_deleting_state(cls, registry_models, platform):
+        return cls(registry_models, platform)
+
+
+class BulkUpdating(object):
+    """ Updates many active registry entries of the same platform (and mapping) with one batched platform
+    interaction. The batch sends the metadata, thumbnails and captions are still sent per entry. Every entry
+    moves on to the active state or to the error state on its own. """
+    interaction_name = 'bulk_update'
+
+    def __init__(self, registry_models, platform):
+        self.registry_models = registry_models
+        self.platform = platform
+        self.interaction = PlatformInteraction()
+        self.video_model_class = VideoModel
+        self.captions_download = download_captions
+
+    def _fire_error(self, registry_model, message):
+        log_error(message)
+        registry_model.message = message
+        Error.create_error_state(registry_model).run()
+
+    def _prepare(self, registry_model):
+        registry_model.set_intermediate_state_and_persist('updating')
+        video_model = self.video_model_class.create_from_video_id(registry_model.video_id)
+        persist_video_image_on_disk(video_model)
+        self.captions_download(video_model)
+        return video_model
+
+    def run(self):
+        log_debug('Entering %s state for %s registry entries and platform %s' % (
+            self.interaction_name, len(self.registry_models), self.platform))
+        videos_and_registries = []
+        for registry_model in self.registry_models:
+            try:
+                videos_and_registries.append((self._prepare(registry_model), registry_model))
+            except Exception as e:
+                log_error(traceback.format_exc())
+                self._fire_error(registry_model, 'Unable to update video with id %s and registry id %s. %s' % (
+                    registry_model.video_id, registry_model.registry_id, build_message_from_exception_chain(e)))
+        if not videos_and_registries:
+            return
+
+        try:
+            results = self.interaction.execute_bulk_platform_interaction(self.platform, self.interaction_name,
+                                                                         videos_and_registries)
+        except Exception as e:
+            traceback.print_exc()
+            log_error(traceback.format_exc())
+            results = dict((registry_model.registry_id, e) for video_model, registry_model in videos_and_registries)
+
+        for video_model, registry_model in videos_and_registries:
+            registry_id = registry_model.registry_id
+            error = results.get(registry_id, Exception('No result for registry id %s.' % registry_id))
+            if error is None:
+                Active.create_active_state(registry_model).run(video_model)
+            elif isinstance(error, SuccessWithWarningException):
+                Active.create_active_state(registry_model, False).run(video_model)
+            else:
+                self._fire_error(registry_model, 'Unable to update video with id %s and registry id %s. %s' % (
+                    registry_model.video_id, registry_id, build_message_from_exception_chain(error)))
+        log_debug('Finished %s state for %s registry entries and platform %s' % (
+            self.interaction_name, len(videos_and_registries), self.platform))
+
+    @classmethod
+    def create_bulk_updating_state(cls, registry_models, platform):
+        return cls(registry_models, platform)
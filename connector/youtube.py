@@ -1,14 +1,23 @@
+import datetime
 import hashlib
+import json
+import os
+import threading
 import time
 import traceback
-from random import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import httplib2
+import pytz
 from commonspy.logging import log_info, log_error, log_debug
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 
-from connector.db import VideoModel, RegistryModel
+from connector import APP_ROOT, config_property
+from connector.db import VideoModel, RegistryModel, MongoDbFactory
+from connector.retry import upload_retry_policy, RetryLimitExceededException
 
 """ This module handles youtube video upload, update
 and unpublish. Videos are only uploaded to multi
@@ -22,12 +31,50 @@ RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError,)
 # codes is raised.
 RETRIABLE_STATUS_CODES = (500, 502, 503, 504,)
 
+# Status codes of an apiclient.errors.HttpError indicating invalid or expired credentials.
+AUTH_ERROR_STATUS_CODES = (401, 403,)
+
 INVALID_CREDENTIALS = b"Invalid Credentials"
 YOUTUBE_API_SERVICE_NAME = 'youtube'
 YOUTUBE_API_VERSION = 'v3'
 YOUTUBE_CONTENT_ID_API_SERVICE_NAME = 'youtubePartner'
 YOUTUBE_CONTENT_ID_API_VERSION = 'v1'
 
+# Chunk sizes of resumable uploads have to be a multiple of 256 KB.
+CHUNK_SIZE_UNIT = 256 * 1024
+INITIAL_CHUNK_SIZE = 8 * 1024 * 1024
+# Upper limit of the chunk size and thereby of the memory used by an upload
+MAX_CHUNK_SIZE = 512 * 1024 * 1024
+# Chunks are sized so that the transfer of a chunk takes about this many seconds.
+TARGET_CHUNK_SECONDS = 30
+
+# Bundled discovery documents, named <service name>.<version>.json (see 'make discovery').
+DISCOVERY_DOCUMENTS_DIR = APP_ROOT + '/config/discovery'
+
+# Maximum number of ids per videos().list request and of requests per batch request.
+BATCH_SIZE = 50
+
+# Estimated quota costs of the youtube data api methods in units.
+QUOTA_COSTS = {
+    'videos.insert': 1600,
+    'videos.list': 1,
+    'videos.update': 50,
+    'captions.insert': 400,
+    'thumbnails.set': 50
+}
+# Default daily quota of a google cloud project.
+DAILY_QUOTA = 10000
+# Low priority work is deferred once fewer units are left (see quota_available).
+QUOTA_RESERVE = 3200
+# Quota needed for the upload of a video including thumbnail and captions.
+UPLOAD_QUOTA_COST = QUOTA_COSTS['videos.insert'] + QUOTA_COSTS['thumbnails.set'] + QUOTA_COSTS['captions.insert']
+# Youtube resets the quota of all projects at midnight pacific time.
+QUOTA_TIMEZONE = pytz.timezone('America/Los_Angeles')
+DEFAULT_QUOTA_PROJECT = 'default'
+
+# Number of threads uploading thumbnails and captions after the insert of a video.
+MEDIA_WORKERS = 4
+
 youtube_scopes = (
     'https://www.googleapis.com/auth/youtube',
     'https://www.googleapis.com/auth/youtube.upload',
@@ -50,6 +97,178 @@ class UnpublishError(Exception):
         pass
 
 
+_discovery_documents = {}
+_discovery_documents_lock = threading.Lock()
+_services = threading.local()
+# The threads are kept alive, so that their cached services (see cached_service) stay warm.
+_media_executor = ThreadPoolExecutor(max_workers=int(config_property('youtube.media_workers', MEDIA_WORKERS)))
+
+
+def build_service(service_name, version, http, quota_project=DEFAULT_QUOTA_PROJECT):
+    """ Builds an api service. The bundled discovery document is used if available, so that
+    no discovery request is necessary. Otherwise the discovery document is fetched from google.
+    The calls of the service are charged to the given project in the quota ledger.
+    """
+    document = _discovery_document(service_name, version)
+    if document is None:
+        log_debug('No bundled discovery document for %s %s found, fetching it.' % (service_name, version))
+        service = build(service_name, version, http=http)
+    else:
+        service = build_from_document(document, http=http)
+    service.quota_project = quota_project
+    return service
+
+
+def _discovery_document(service_name, version):
+    key = '%s.%s' % (service_name, version)
+    with _discovery_documents_lock:
+        if key not in _discovery_documents:
+            path = os.path.join(DISCOVERY_DOCUMENTS_DIR, key + '.json')
+            if os.path.isfile(path):
+                with open(path) as file:
+                    _discovery_documents[key] = file.read()
+            else:
+                _discovery_documents[key] = None
+        return _discovery_documents[key]
+
+
+def cached_service(credential, factory, fingerprint=None):
+    """ Returns the service(s) created by the factory for the given credential. Built services are
+    cached per thread, as the underlying http connections must not be shared between threads.
+
+    :param credential: key identifying the credential the services are authorized with
+    :param factory: callable building the service(s)
+    :param fingerprint: optional value, the services are rebuilt if it changes (e.g. a new access token)
+    :return: the cached service(s)
+    """
+    cache = getattr(_services, 'by_credential', None)
+    if cache is None:
+        cache = _services.by_credential = {}
+    entry = cache.get(credential)
+    if entry is None or entry[0] != fingerprint:
+        entry = (fingerprint, factory())
+        cache[credential] = entry
+    return entry[1]
+
+
+class QuotaLedger(object):
+    """ Estimated quota usage of the youtube api per project and day. The usage is kept in
+    mongo db, so that it survives restarts and is shared by all instances of the connector.
+    Days start at midnight pacific time, when youtube resets the quota.
+    """
+
+    def __init__(self, collection_factory, daily_limit, costs=QUOTA_COSTS):
+        self.collection_factory = collection_factory
+        self.daily_limit = daily_limit
+        self.costs = costs
+
+    def charge(self, project, method, count=1):
+        """ Records count calls of the given api method (e.g. 'videos.insert'). Errors are only
+        logged, as the ledger must never break the actual api calls.
+        """
+        units = self.costs.get(method, 0) * count
+        day = quota_day()
+        try:
+            self.collection_factory().update_one(
+                {'_id': '%s:%s' % (project, day)},
+                {
+                    '$inc': {'used': units, 'methods.%s' % method.replace('.', '_'): units},
+                    '$setOnInsert': {'project': project, 'day': day}
+                },
+                upsert=True)
+        except Exception as e:
+            log_error('Cannot record quota usage of %s units for project %s. Error: %s' % (units, project, e))
+
+    def used(self, project):
+        document = self.collection_factory().find_one({'_id': '%s:%s' % (project, quota_day())})
+        return document['used'] if document else 0
+
+    def remaining(self, project):
+        return max(0, self.daily_limit - self.used(project))
+
+    def usage(self):
+        """ Returns the usage of today per project. """
+        result = {}
+        for document in self.collection_factory().find({'day': quota_day()}):
+            result[document['project']] = dict(
+                used=document['used'],
+                remaining=max(0, self.daily_limit - document['used']),
+                limit=self.daily_limit,
+                methods=document.get('methods', {})
+            )
+        return result
+
+
+def quota_day():
+    return datetime.datetime.now(QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+
+def charge_quota(service, method, count=1):
+    quota_ledger.charge(getattr(service, 'quota_project', DEFAULT_QUOTA_PROJECT), method, count)
+
+
+def quota_available(project, priority):
+    """ Checks whether work of the given priority should be started with the remaining quota of the project.
+    'high' priority work (e.g. unpublishing) is never deferred. 'normal' work needs enough quota for a
+    complete upload, 'low' priority work leaves the reserve of youtube_quota.reserve units untouched.
+    """
+    if priority == 'high':
+        return True
+    try:
+        remaining = quota_ledger.remaining(project)
+    except Exception as e:
+        log_error('Cannot read quota usage of project %s. Error: %s' % (project, e))
+        return True
+    if priority == 'low':
+        return remaining >= int(config_property('youtube_quota.reserve', QUOTA_RESERVE))
+    return remaining >= UPLOAD_QUOTA_COST
+
+
+quota_ledger = QuotaLedger(MongoDbFactory.connector_quota_collection,
+                           int(config_property('youtube_quota.daily_limit', DAILY_QUOTA)))
+
+
+class AdaptiveMediaFileUpload(MediaFileUpload):
+    """ Resumable MediaFileUpload whose chunk size adapts to the measured throughput. The upload starts with a small
+    chunk, grows the chunks (at most doubling them) until a chunk takes about TARGET_CHUNK_SECONDS and halves the
+    chunk size after errors. The chunk size never exceeds max_chunksize.
+    """
+
+    def __init__(self, filename, max_chunksize=MAX_CHUNK_SIZE, initial_chunksize=INITIAL_CHUNK_SIZE, mimetype=None):
+        max_chunksize = max(CHUNK_SIZE_UNIT, max_chunksize - max_chunksize % CHUNK_SIZE_UNIT)
+        super().__init__(filename, mimetype=mimetype, chunksize=min(initial_chunksize, max_chunksize),
+                         resumable=True)
+        self.filename = filename
+        self.max_chunksize = max_chunksize
+        self.current_chunksize = min(initial_chunksize, max_chunksize)
+
+    def chunksize(self):
+        return self.current_chunksize
+
+    def chunk_transferred(self, transferred, seconds):
+        if transferred <= 0:
+            return
+        target = transferred / max(seconds, 0.001) * TARGET_CHUNK_SECONDS
+        self._set_chunksize(min(target, 2 * self.current_chunksize))
+
+    def chunk_failed(self):
+        self._set_chunksize(self.current_chunksize / 2)
+
+    def _set_chunksize(self, chunksize):
+        chunksize = int(chunksize) - int(chunksize) % CHUNK_SIZE_UNIT
+        self.current_chunksize = max(CHUNK_SIZE_UNIT, min(chunksize, self.max_chunksize))
+        log_debug('Chunk size of upload of %s set to %s bytes.' % (self.filename, self.current_chunksize))
+
+
+def is_auth_error(exception):
+    """ Checks whether the exception (or one of its causes) was raised because the request was not authorized. """
+    while exception is not None:
+        if isinstance(exception, HttpError) and exception.resp.status in AUTH_ERROR_STATUS_CODES:
+            return True
+        exception = exception.__cause__
+    return False
+
+
 def create_metadata_hash(metadata):
     """
 
@@ -69,25 +288,42 @@ def create_metadata_hash(metadata):
     return video_hash_code.hexdigest()
 
 
-def resumable_upload(insert_request):
+def resumable_upload(insert_request, registry: RegistryModel=None):
     """ Actually uploads the video to youtube.
     If an error occours the function will retry the
     upload. (with time span between uploads).
+    If a registry entry is given, the resumable session
+    uri and the upload progress are persisted with it
+    after each chunk (see resume_upload_session).
+    The chunk size of an AdaptiveMediaFileUpload is
+    adjusted after every chunk. Retries back off according
+    to the upload retry policy, the retry counter is reset
+    after every transferred chunk.
     """
+    media = insert_request.resumable
+    adaptive = isinstance(media, AdaptiveMediaFileUpload)
     response = None
     error = None
-    retry = 0
+    backoff = upload_retry_policy.start()
     video_id = None
     while response is None:
+        error = None
         try:
             log_info('Uploading file...')
+            progress = insert_request.resumable_progress
+            started = time.monotonic()
             status, response = insert_request.next_chunk()
+            if adaptive:
+                media.chunk_transferred(insert_request.resumable_progress - progress, time.monotonic() - started)
             if response is not None:
                 if 'id' in response:
                     video_id = response['id']
                     log_info('Video id %s was successfully uploaded.' % video_id)
                 else:
                     raise Exception('The upload failed with an unexpected response: %s' % response)
+            elif registry is not None:
+                _persist_upload_session(insert_request, registry)
+            backoff.reset()
         except HttpError as e:
             if e.resp.status in RETRIABLE_STATUS_CODES:
                 error = 'A retriable HTTP error %d occurred:\n%s' % (e.resp.status, e.content)
@@ -98,18 +334,68 @@ def resumable_upload(insert_request):
 
         if error is not None:
             log_error('Error during upload, retrying it. Message: %s' % error)
-            retry += 1
-            if retry > 10:
-                raise Exception('No longer attempting to retry.')
-
-            max_sleep = 2 ** retry
-            sleep_seconds = random.random() * max_sleep
-            log_info('Sleeping %f seconds and then retrying...' % sleep_seconds)
-            time.sleep(sleep_seconds)
+            if adaptive:
+                media.chunk_failed()
+            try:
+                backoff.wait(error)
+            except RetryLimitExceededException as e:
+                raise Exception('No longer attempting to retry.') from e
     return video_id
 
 
-def upload(youtube, video: VideoModel, content_owner_id, channel_id):
+def _persist_upload_session(insert_request, registry: RegistryModel):
+    if insert_request.resumable_uri is None:
+        return
+    upload_session = dict(
+        platform='youtube',
+        resumable_uri=insert_request.resumable_uri,
+        progress=insert_request.resumable_progress,
+        file_size=insert_request.resumable.size()
+    )
+    if upload_session != registry.upload_session:
+        registry.set_upload_session_and_persist(upload_session)
+
+
+def resume_upload_session(insert_request, registry: RegistryModel):
+    """ Continues the resumable upload session persisted with the registry entry, if there is one for the same file.
+    The session status is queried from youtube and the insert request is set up to continue with the first byte
+    not yet committed.
+
+    :param insert_request: new insert request for the video
+    :param registry: registry entry of the video
+    :return: the response of youtube if the upload was already completed, otherwise None
+    """
+    upload_session = registry.upload_session
+    file_size = insert_request.resumable.size()
+    if not upload_session or upload_session.get('platform') != 'youtube' or upload_session.get('file_size') != file_size:
+        return None
+
+    resumable_uri = upload_session['resumable_uri']
+    try:
+        response, content = insert_request.http.request(resumable_uri, method='PUT', body='', headers={
+            'Content-Range': 'bytes */%d' % file_size,
+            'Content-Length': '0'
+        })
+    except RETRIABLE_EXCEPTIONS as e:
+        log_error('Cannot query status of upload session for registry %s, starting new upload. Error: %s' % (
+            registry.registry_id, e))
+        return None
+
+    if response.status in (200, 201):
+        log_info('Upload session of registry %s was already completed.' % registry.registry_id)
+        return json.loads(content.decode('utf-8'))
+    if response.status == 308:
+        progress = int(response['range'].rsplit('-', 1)[1]) + 1 if 'range' in response else 0
+        log_info('Resuming upload session of registry %s at byte %s of %s.' % (registry.registry_id, progress, file_size))
+        insert_request.resumable_uri = resumable_uri
+        insert_request.resumable_progress = progress
+        return None
+    log_info('Upload session of registry %s expired (status %s), starting new upload.' % (
+        registry.registry_id, response.status))
+    return None
+
+
+def upload(youtube, video: VideoModel, content_owner_id, channel_id, registry: RegistryModel=None):
     """ initialized the youtube video upload. This
     mechanism uses the youtube partner authentication / client
     and is only able to upload videos to a multi channel
@@ -119,7 +405,8 @@ def upload(youtube, video: VideoModel, content_owner_id, channel_id):
     :param video: video metadata
     :param content_owner_id: the id of the channel owner
     :param channel_id: the target channel
-    :return: resumable upload
+    :param registry: optional registry entry, its persisted upload session is resumed (see resume_upload_session)
+    :return: the youtube id of the uploaded video
     """
 
     body = dict(
@@ -139,10 +426,16 @@ def upload(youtube, video: VideoModel, content_owner_id, channel_id):
         body=body,
         onBehalfOfContentOwner=content_owner_id,
         onBehalfOfContentOwnerChannel=channel_id,
-        # chunk size: 512 MB
-        media_body=MediaFileUpload(video.filename, chunksize=512 * 1024 * 1024, resumable=True)
+        media_body=AdaptiveMediaFileUpload(video.filename,
+                                           max_chunksize=int(config_property('youtube.max_chunk_size', MAX_CHUNK_SIZE)))
     )
-    return resumable_upload(insert_request)
+    if registry is not None:
+        response = resume_upload_session(insert_request, registry)
+        if response is not None:
+            return response.get('id')
+    if insert_request.resumable_uri is None:
+        charge_quota(youtube, 'videos.insert')
+    return resumable_upload(insert_request, registry)
 
 
 def upload_thumbnail_for_video_if_exists(youtube, content_owner, image_filename, yt_video_id, registry: RegistryModel):
@@ -153,10 +446,11 @@ def upload_thumbnail_for_video_if_exists(youtube, content_owner, image_filename,
     :param content_owner: id of content owner
     :param image_filename: path of thumbnail tu set
     :param yt_video_id: youtube id of video
-    :return:
+    :return: warning message if the thumbnail could not be set, otherwise None
     """
     try:
         if image_filename:
+            charge_quota(youtube, 'thumbnails.set')
             youtube.thumbnails().set(
                 videoId=yt_video_id,
                 media_body=image_filename,
@@ -166,16 +460,23 @@ def upload_thumbnail_for_video_if_exists(youtube, content_owner, image_filename,
             log_info("No thumbnail for youtube video id %s" % yt_video_id)
 
     except Exception as e:
-        registry.message = 'Error uploading thumb of registry entry %s to youtube. Error: %s' % (
-            registry.registry_id, e)
-        log_error(registry.message)
+        message = 'Error uploading thumb of registry entry %s to youtube. Error: %s' % (registry.registry_id, e)
+        log_error(message)
         log_error(e.__traceback__)
+        return message
+    return None
 
 
 def upload_captions_for_video_if_exists(youtube, captions_filename, yt_video_id, registry: RegistryModel):
+    """
+    Upload the captions of an existing video. The caller sets the captions flag of the registry entry.
+
+    :return: tuple of whether captions were uploaded and the warning message if they could not be uploaded
+    """
     try:
         if captions_filename:
             log_info('Uploading captions for video %s and registry %s' % (yt_video_id, registry.registry_id))
+            charge_quota(youtube, 'captions.insert')
             youtube.captions().insert(
                 part="snippet",
                 body=dict(
@@ -187,34 +488,85 @@ def upload_captions_for_video_if_exists(youtube, captions_filename, yt_video_id,
                 ),
                 media_body=captions_filename
             ).execute()
-            registry.set_captions_uploaded_and_persist(True)
+            return True, None
         else:
             log_info('No captions to uplaod for youtube video %s and registry %s' % (yt_video_id, registry.registry_id))
     except Exception as e:
-        registry.message = 'Error uploading captions of registry entry %s to youtube. Error: %s' % (registry.registry_id, e)
-        log_error(registry.message)
+        message = 'Error uploading captions of registry entry %s to youtube. Error: %s' % (registry.registry_id, e)
+        log_error(message)
         log_error(traceback.format_exc())
+        return False, message
+    return False, None
+
 
+def upload_thumbnail_and_captions(youtube, service_factory, content_owner, video: VideoModel, yt_video_id,
+                                  registry: RegistryModel):
+    """ Sets thumbnail and captions of an uploaded video concurrently. Both calls run on the media
+    executor with a service of their own thread, as http connections must not be shared between
+    threads. Without a service_factory both calls are made one after the other with the given service.
 
-def upload_video_to_youtube(youtube, video: VideoModel, registry: RegistryModel, content_owner, channel_id):
+    :return: tuple of whether captions were uploaded and the list of warning messages
+    """
+    if service_factory is None:
+        thumbnail_warning = upload_thumbnail_for_video_if_exists(youtube, content_owner, video.image_filename,
+                                                                 yt_video_id, registry)
+        captions_uploaded, captions_warning = upload_captions_for_video_if_exists(youtube, video.captions_filename,
+                                                                                  yt_video_id, registry)
+    else:
+        thumbnail = _media_executor.submit(lambda: upload_thumbnail_for_video_if_exists(
+            service_factory(), content_owner, video.image_filename, yt_video_id, registry))
+        captions = _media_executor.submit(lambda: upload_captions_for_video_if_exists(
+            service_factory(), video.captions_filename, yt_video_id, registry))
+        try:
+            thumbnail_warning = thumbnail.result()
+        except Exception as e:
+            thumbnail_warning = _media_warning(registry, e)
+        try:
+            captions_uploaded, captions_warning = captions.result()
+        except Exception as e:
+            captions_uploaded, captions_warning = False, _media_warning(registry, e)
+    return captions_uploaded, [warning for warning in (thumbnail_warning, captions_warning) if warning]
+
+
+def _media_warning(registry: RegistryModel, e):
+    log_error(traceback.format_exc())
+    return 'Error uploading media of registry entry %s to youtube. Error: %s' % (registry.registry_id, e)
+
+
+def upload_video_to_youtube(youtube, video: VideoModel, registry: RegistryModel, content_owner, channel_id,
+                            service_factory=None):
     """ Triggers the video upload initialization method.
     For each video the gathered metadata will be set
     and the video will be uploaded. In case of an error
     the upload mechanism retries the upload. Uploading
     errors are logged into a mongo db collection.
+    Thumbnail and captions are set concurrently with
+    services created by the optional service_factory
+    (see upload_thumbnail_and_captions). If one of them
+    fails, the warnings are kept as registry message and
+    a SuccessWithWarningException is raised.
     """
 
     try:
-        video_id = upload(youtube, video, content_owner, channel_id)
+        video_id = upload(youtube, video, content_owner, channel_id, registry)
 
         if video_id and video_id != '':
             registry.target_platform_video_id = video_id
-            upload_thumbnail_for_video_if_exists(youtube, content_owner, video.image_filename, video_id, registry)
-            upload_captions_for_video_if_exists(youtube, video.captions_filename, video_id, registry)
+            registry.upload_session = None
+            captions_uploaded, warnings = upload_thumbnail_and_captions(youtube, service_factory, content_owner,
+                                                                        video, video_id, registry)
+            if captions_uploaded:
+                registry.set_captions_uploaded_and_persist(True)
+            if warnings:
+                registry.message = ' '.join(warnings)
             registry.set_state_and_persist('active')
+            if warnings:
+                raise SuccessWithWarningException()
         else:
             raise Exception('Upload failed, no youtube_id responded for registry %s' % registry.registry_id)
 
+    except SuccessWithWarningException:
+        raise
     except Exception as e:
         raise Exception('Error uploading video of registry entry %s to youtube.' % registry.registry_id) from e
 
@@ -222,7 +574,10 @@ def upload_video_to_youtube(youtube, video: VideoModel, registry: RegistryModel,
 
 
 def update_video_on_youtube(youtube, video: VideoModel, registry: RegistryModel, content_owner):
-    """ Update metadata of video on youtube. Currently only captions are updated, if not already uploaded. """
+    """ Update metadata of video on youtube. Currently only captions are updated, if not already uploaded.
+    If captions or thumbnail fail, the warnings are kept as registry message and a SuccessWithWarningException
+    is raised.
+    """
 
     if registry.captions_uploaded:
         log_info('Captions already uploaded for video with id %s.' % registry.video_id)
@@ -233,19 +588,34 @@ def update_video_on_youtube(youtube, video: VideoModel, registry: RegistryModel,
     if not youtube_id:
         raise UpdateError('Youtube_id not found for %s.' % registry.registry_id)
 
-    upload_captions_for_video_if_exists(youtube, video.captions_filename, youtube_id, registry)
+    captions_uploaded, warning = upload_captions_for_video_if_exists(youtube, video.captions_filename, youtube_id,
+                                                                     registry)
+    if captions_uploaded:
+        registry.set_captions_uploaded_and_persist(True)
+    warnings = [warning]
 
     # old code for updating videos on youtube. Kept as updating might be supported some time in the near future
     if video.hash_code == registry.video_hash_code:
         log_info('Metadata of registry entry %s not changed, so no update needed.' % registry.registry_id)
-        return
-    upload_thumbnail_for_video_if_exists(youtube, content_owner, video.image_filename, youtube_id, registry)
+    else:
+        warnings.append(upload_thumbnail_for_video_if_exists(youtube, content_owner, video.image_filename, youtube_id,
+                                                             registry))
+        _update_snippet_on_youtube(youtube, video, registry, content_owner)
+
+    warnings = [warning for warning in warnings if warning]
+    if warnings:
+        registry.message = ' '.join(warnings)
+        raise SuccessWithWarningException()
+
+
+def _update_snippet_on_youtube(youtube, video: VideoModel, registry: RegistryModel, content_owner):
     youtube_id = registry.target_platform_video_id
 
     if youtube_id is None:
         raise UpdateError('Youtube_id not found for ' + registry.registry_id)
 
     try:
+        charge_quota(youtube, 'videos.list')
         video_list_response = youtube.videos().list(
             id=youtube_id,
             part='snippet'
@@ -259,6 +629,7 @@ def update_video_on_youtube(youtube, video: VideoModel, registry: RegistryModel,
         video_metadata['description'] = video.description
         video_metadata['tags'] = video.keywords
 
+        charge_quota(youtube, 'videos.update')
         youtube.videos().update(
             part='snippet',
             onBehalfOfContentOwner=content_owner,
@@ -271,6 +642,63 @@ def update_video_on_youtube(youtube, video: VideoModel, registry: RegistryModel,
         raise Exception('Error updating video of registry entry %s on youtube.' % registry.registry_id) from e
 
 
+def update_videos_on_youtube(youtube, videos_and_registries, content_owner):
+    """ Batched variant of update_video_on_youtube. Captions and
+    thumbnails are still uploaded per video, the snippets of all
+    videos with changed metadata are updated in batches (see
+    batch_update_videos).
+
+    :param videos_and_registries: list of tuples of video and registry entry
+    :return: dict mapping each registry id to None if its video
+    was updated, to a SuccessWithWarningException if only captions
+    or thumbnail failed (the warnings are kept as registry
+    message), otherwise to the error
+    """
+    results = {}
+    warnings = {}
+    videos = {}
+    changed = []
+    for video, registry in videos_and_registries:
+        registry_id = registry.registry_id
+        results[registry_id] = None
+        if registry.captions_uploaded:
+            log_info('Captions already uploaded for video with id %s.' % registry.video_id)
+            continue
+        youtube_id = registry.target_platform_video_id
+        if not youtube_id:
+            results[registry_id] = UpdateError('Youtube_id not found for %s.' % registry_id)
+            continue
+
+        captions_uploaded, warning = upload_captions_for_video_if_exists(youtube, video.captions_filename, youtube_id,
+                                                                         registry)
+        if captions_uploaded:
+            registry.set_captions_uploaded_and_persist(True)
+        warnings[registry_id] = [warning]
+
+        if video.hash_code == registry.video_hash_code:
+            log_info('Metadata of registry entry %s not changed, so no update needed.' % registry_id)
+        else:
+            warnings[registry_id].append(upload_thumbnail_for_video_if_exists(
+                youtube, content_owner, video.image_filename, youtube_id, registry))
+            videos[registry_id] = video
+            changed.append(registry)
+
+    def set_snippet(registry, snippet):
+        video = videos[registry.registry_id]
+        snippet['title'] = video.title
+        snippet['description'] = video.description
+        snippet['tags'] = video.keywords
+
+    if changed:
+        results.update(batch_update_videos(youtube, changed, content_owner, 'snippet', set_snippet))
+    for video, registry in videos_and_registries:
+        registry_warnings = [warning for warning in warnings.get(registry.registry_id, []) if warning]
+        if registry_warnings and results[registry.registry_id] is None:
+            registry.message = ' '.join(registry_warnings)
+            results[registry.registry_id] = SuccessWithWarningException()
+    return results
+
+
 def unpublish_video_on_youtube(youtube, video: VideoModel, registry: RegistryModel, content_owner):
     """ Set the privacyStatus to 'private' of the given video if it
     was uploaded to youtube.
@@ -280,6 +708,7 @@ def unpublish_video_on_youtube(youtube, video: VideoModel, registry: RegistryMod
     if youtube_id is None:
         raise UnpublishError('Youtube_id not found for ' + registry.registry_id)
     try:
+        charge_quota(youtube, 'videos.list')
         video_list_response = youtube.videos().list(
             id=youtube_id,
             part='status'
@@ -289,6 +718,7 @@ def unpublish_video_on_youtube(youtube, video: VideoModel, registry: RegistryMod
 
         video_list_snippet = video_list_response['items'][0]['status']
         video_list_snippet['privacyStatus'] = 'private'
+        charge_quota(youtube, 'videos.update')
         youtube.videos().update(
             part='status',
             onBehalfOfContentOwner=content_owner,
@@ -301,27 +731,80 @@ def unpublish_video_on_youtube(youtube, video: VideoModel, registry: RegistryMod
         raise Exception('Error unpublishing video of registry entry %s on youtube.' % registry.registry_id) from e
 
 
-def claim_video_on_youtube(youtube_partner, content_owner_id, target_platform_video_id, video: VideoModel, registry: RegistryModel):
-    """ Performs all steps to claim a video on the youtube platform and upload a referenc.
+def unpublish_videos_on_youtube(youtube, registries, content_owner):
+    """ Batched variant of unpublish_video_on_youtube. Sets the
+    privacyStatus of the videos of all given registry entries
+    to 'private' (see batch_update_videos).
+    """
+    def set_private(registry, status):
+        status['privacyStatus'] = 'private'
+
+    return batch_update_videos(youtube, registries, content_owner, 'status', set_private)
+
 
-    After these steps have been performed successfully a UploadPolicy and a MatchPolicy are set for the
-    video content. Thus, all videos with the same content are automatically claimed and our policies 'track' are
-    applied to it.
+def batch_update_videos(youtube, registries, content_owner, part, modify):
+    """ Updates the given part of the videos of many registry
+    entries. The videos are fetched with one videos().list
+    request per BATCH_SIZE ids and updated with one batch
+    request per BATCH_SIZE videos. modify(registry, resource)
+    changes the fetched part of a video in place.
+
+    :return: dict mapping each registry id to None if its
+    video was updated, otherwise to the error
     """
-    try:
-        log_info("Setting policies for video: %s" % video.__dict__)
-        asset_id = create_asset(youtube_partner, content_owner_id, video.title, video.description)
-        set_asset_ownership(youtube_partner, content_owner_id, asset_id)
-        claim_id = claim_video(youtube_partner, content_owner_id, asset_id, target_platform_video_id)
-        # The following methods are required to set the match policy for a video.
-        # Currently we do not set this automatically.
-        # set_match_policy(youtube_partner, asset_id)
-        # create_reference(youtube_partner, asset_id, video.filename)
-    except Exception as e:
-        log_error('Error setting policies on video with id "%s" and id on target platform "%s". Error %s' % (video.video_id, target_platform_video_id, e))
-        log_error(traceback.format_tb(e.__traceback__))
-        registry.set_message_and_persist("Warning while setting policies: %s" % e)
-        raise SuccessWithWarningException() from e
+    results = {}
+    registries_by_youtube_id = OrderedDict()
+    for registry in registries:
+        if registry.target_platform_video_id is None:
+            results[registry.registry_id] = UpdateError('Youtube_id not found for ' + registry.registry_id)
+        else:
+            registries_by_youtube_id.setdefault(registry.target_platform_video_id, []).append(registry)
+
+    def set_result(youtube_id, error):
+        for registry in registries_by_youtube_id[youtube_id]:
+            results[registry.registry_id] = error
+
+    youtube_ids = list(registries_by_youtube_id)
+    for start in range(0, len(youtube_ids), BATCH_SIZE):
+        chunk = youtube_ids[start:start + BATCH_SIZE]
+        try:
+            charge_quota(youtube, 'videos.list')
+            video_list_response = youtube.videos().list(
+                id=','.join(chunk),
+                part=part
+            ).execute()
+        except Exception as e:
+            for youtube_id in chunk:
+                set_result(youtube_id, e)
+            continue
+        resources = dict((item['id'], item[part]) for item in video_list_response['items'])
+
+        batch = youtube.new_batch_http_request()
+        updates = 0
+        for youtube_id in chunk:
+            if youtube_id not in resources:
+                set_result(youtube_id, UpdateError('Video with id %s not found on youtube.' % youtube_id))
+                continue
+            resource = resources[youtube_id]
+            modify(registries_by_youtube_id[youtube_id][0], resource)
+            request = youtube.videos().update(
+                part=part,
+                onBehalfOfContentOwner=content_owner,
+                body={part: resource, 'id': youtube_id}
+            )
+            batch.add(request, request_id=youtube_id,
+                      callback=lambda request_id, response, exception: set_result(request_id, exception))
+            updates += 1
+        try:
+            charge_quota(youtube, 'videos.update', updates)
+            batch.execute()
+        except Exception as e:
+            for youtube_id in chunk:
+                if registries_by_youtube_id[youtube_id][0].registry_id not in results:
+                    set_result(youtube_id, e)
+    log_info('Updated %s of %s videos on youtube in batches.' % (
+        len([error for error in results.values() if error is None]), len(results)))
+    return results
 
 
 def create_asset(youtube_partner, content_owner_id, title, description):
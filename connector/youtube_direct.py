@@ -1,31 +1,88 @@
+import threading
+import time
 import urllib
+from functools import partial
 
 import httplib2
 import requests
-from googleapiclient.discovery import build
 from oauth2client.client import AccessTokenCredentials
 
-from connector import config
+from connector import config, config_property
 from connector.db import VideoModel, RegistryModel, MappingModel
 from connector.youtube import YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, upload_video_to_youtube, \
-    update_video_on_youtube, unpublish_video_on_youtube
+    update_video_on_youtube, update_videos_on_youtube, unpublish_video_on_youtube, unpublish_videos_on_youtube, \
+    build_service, cached_service, is_auth_error, quota_available, SuccessWithWarningException
+
+# Name of the google cloud project of the oauth client in the quota ledger
+QUOTA_PROJECT = config_property('youtube.quota_project', 'direct')
+
+# Access tokens are refreshed this many seconds before they expire.
+ACCESS_TOKEN_REFRESH_MARGIN = 300
+# Lifetime assumed if the token response contains no expires_in.
+DEFAULT_ACCESS_TOKEN_LIFETIME = 3600
+
+_access_tokens = {}
+_access_token_locks = {}
+_access_tokens_lock = threading.Lock()
 
 
 def youtube_direct_inst(target_id):
     access_token = access_token_from_refresh_token(target_id)
+    return cached_service(target_id, partial(_build_youtube_direct, access_token), fingerprint=access_token)
+
+
+def _build_youtube_direct(access_token):
     credentials = AccessTokenCredentials(access_token, "MyAgent/1.0", None)
 
     if credentials is None or credentials.invalid:
         raise Exception('Cannot create access_token from refresh_token.')
 
     http = httplib2.Http()
-    youtube = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-                    http=credentials.authorize(http))
+    youtube = build_service(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
+                            http=credentials.authorize(http), quota_project=QUOTA_PROJECT)
 
     return youtube
 
 
 def access_token_from_refresh_token(refresh_token):
+    """ Returns an access token for the given refresh token. Access tokens are cached until
+    shortly before they expire. Concurrent refreshes for the same refresh token are coalesced
+    into one token request.
+    """
+    access_token = _cached_access_token(refresh_token)
+    if access_token:
+        return access_token
+    with _access_token_lock(refresh_token):
+        # another thread might have refreshed the token in the meantime
+        access_token = _cached_access_token(refresh_token)
+        if access_token:
+            return access_token
+        access_token, expires_in = _request_access_token(refresh_token)
+        with _access_tokens_lock:
+            _access_tokens[refresh_token] = (access_token,
+                                             time.monotonic() + expires_in - ACCESS_TOKEN_REFRESH_MARGIN)
+        return access_token
+
+
+def invalidate_access_token(refresh_token):
+    with _access_tokens_lock:
+        _access_tokens.pop(refresh_token, None)
+
+
+def _cached_access_token(refresh_token):
+    with _access_tokens_lock:
+        cached = _access_tokens.get(refresh_token)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def _access_token_lock(refresh_token):
+    with _access_tokens_lock:
+        return _access_token_locks.setdefault(refresh_token, threading.Lock())
+
+
+def _request_access_token(refresh_token):
     data = urllib.parse.urlencode({
         'grant_type': 'refresh_token',
         'client_id': config.property('youtube.client_id'),
@@ -40,46 +97,115 @@ def access_token_from_refresh_token(refresh_token):
     if 'error' in response:
         raise Exception('Error getting access_token: %s' % response['error'])
 
-    return response['access_token']
+    return response['access_token'], int(response.get('expires_in', DEFAULT_ACCESS_TOKEN_LIFETIME))
 
 
 def upload_video_to_youtube_direct(video: VideoModel, registry: RegistryModel):
     if registry.target_platform_video_id or registry.intermediate_state != 'uploading':
         raise Exception('Upload not triggered because registry %s is not in correct state' % registry.registry_id)
 
+    mapping = None
     try:
         mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
         youtube = youtube_direct_inst(mapping.target_id)
         content_owner = None
         channel_id = None
-        upload_video_to_youtube(youtube, video, registry, content_owner, channel_id)
+        upload_video_to_youtube(youtube, video, registry, content_owner, channel_id,
+                                service_factory=partial(youtube_direct_inst, mapping.target_id))
+    except SuccessWithWarningException as warning:
+        raise warning
     except Exception as e:
+        _invalidate_access_token_on_auth_error(e, mapping)
         raise Exception('Error initializing direct youtube upload request for entry %s.' % registry.registry_id) from e
 
 
 def update_video_on_youtube_direct(video: VideoModel, registry: RegistryModel):
     if registry.target_platform_video_id is None or registry.intermediate_state != 'updating':
         raise Exception('Upload not triggered because registry %s is not in correct state' % registry.registry_id)
+    mapping = None
     try:
         mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
         youtube = youtube_direct_inst(mapping.target_id)
         content_owner = None
         update_video_on_youtube(youtube, video, registry, content_owner)
+    except SuccessWithWarningException as warning:
+        raise warning
     except Exception as e:
+        _invalidate_access_token_on_auth_error(e, mapping)
         raise Exception('Error initializing direct youtube update request for entry %s.' % registry.registry_id) from e
 
 
+def update_videos_on_youtube_direct(videos_and_registries):
+    """ Updates the videos of many registry entries sharing the same mapping (i.e. channel), the metadata is updated
+    with batched requests.
+
+    :param videos_and_registries: list of tuples of video and registry entry
+    :return: dict mapping each registry id to None on success, to a SuccessWithWarningException if only
+    thumbnail or captions failed, otherwise to the error
+    """
+    mapping_ids = set(registry.mapping_id for video, registry in videos_and_registries)
+    if len(mapping_ids) != 1:
+        raise Exception('Bulk update requires registry entries of exactly one mapping, got %s.' % len(mapping_ids))
+    mapping = None
+    try:
+        mapping = MappingModel.create_from_mapping_id(mapping_ids.pop())
+        youtube = youtube_direct_inst(mapping.target_id)
+        results = update_videos_on_youtube(youtube, videos_and_registries, None)
+    except Exception as e:
+        _invalidate_access_token_on_auth_error(e, mapping)
+        raise Exception('Error initializing direct youtube bulk update request for %s entries.' % len(
+            videos_and_registries)) from e
+    for error in results.values():
+        if error is not None:
+            _invalidate_access_token_on_auth_error(error, mapping)
+    return results
+
+
 def unpublish_video_on_youtube_direct(video: VideoModel, registry: RegistryModel):
     if registry.target_platform_video_id is None or registry.intermediate_state not in ('unpublishing', 'deleting'):
         raise Exception('Unpublishing not triggered because registry %s is not in correct state' % registry.registry_id)
+    mapping = None
     try:
         mapping = MappingModel.create_from_mapping_id(registry.mapping_id)
         youtube = youtube_direct_inst(mapping.target_id)
         content_owner = None
         unpublish_video_on_youtube(youtube, video, registry, content_owner)
     except Exception as e:
+        _invalidate_access_token_on_auth_error(e, mapping)
         raise Exception('Error initializing direct youtube unpublish request for entry %s.' % registry.registry_id) from e
 
 
 def delete_video_on_youtube_direct(video: VideoModel, registry: RegistryModel):
     unpublish_video_on_youtube_direct(video, registry)
+
+
+def quota_available_for_youtube_direct(priority):
+    return quota_available(QUOTA_PROJECT, priority)
+
+
+def unpublish_videos_on_youtube_direct(registries):
+    """ Unpublishes the videos of many registry entries sharing the same mapping (i.e. channel) with batched
+    requests.
+
+    :return: dict mapping each registry id to None on success, otherwise to the error
+    """
+    mapping_ids = set(registry.mapping_id for registry in registries)
+    if len(mapping_ids) != 1:
+        raise Exception('Bulk unpublish requires registry entries of exactly one mapping, got %s.' % len(mapping_ids))
+    mapping = None
+    try:
+        mapping = MappingModel.create_from_mapping_id(mapping_ids.pop())
+        youtube = youtube_direct_inst(mapping.target_id)
+        results = unpublish_videos_on_youtube(youtube, registries, None)
+    except Exception as e:
+        _invalidate_access_token_on_auth_error(e, mapping)
+        raise Exception('Error initializing direct youtube bulk unpublish request for %s entries.' % len(registries)) from e
+    for error in results.values():
+        if error is not None:
+            _invalidate_access_token_on_auth_error(error, mapping)
+    return results
+
+
+def _invalidate_access_token_on_auth_error(exception, mapping):
+    if mapping is not None and is_auth_error(exception):
+        invalidate_access_token(mapping.target_id)
@@ -1,14 +1,46 @@
+import threading
+import traceback
+from functools import partial
+
 import httplib2
-from googleapiclient.discovery import build
+from commonspy.logging import log_info, log_error, log_warning
 from googleapiclient.errors import HttpError
 from oauth2client.service_account import ServiceAccountCredentials
 
-from connector import APP_ROOT
+from connector import APP_ROOT, config_property
 from connector.db import RegistryModel, MappingModel
 from connector.db import VideoModel
+from connector.jobs import JobQueue, QueueFullException
+from connector.retry import RetryPolicy, RetryLimitExceededException
 from connector.youtube import youtube_scopes, YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, \
     YOUTUBE_CONTENT_ID_API_SERVICE_NAME, YOUTUBE_CONTENT_ID_API_VERSION, upload_video_to_youtube, \
-    update_video_on_youtube, unpublish_video_on_youtube, claim_video_on_youtube, SuccessWithWarningException
+    update_video_on_youtube, update_videos_on_youtube, unpublish_video_on_youtube, unpublish_videos_on_youtube, \
+    create_asset, set_asset_ownership, claim_video, build_service, cached_service, is_auth_error, quota_available, \
+    SuccessWithWarningException
+
+CLIENT_SECRETS_FILE = APP_ROOT + '/config/client_secrets.json'
+# Name of the google cloud project of the service account in the quota ledger
+QUOTA_PROJECT = config_property('youtube_mcn.quota_project', 'mcn')
+
+# Content id claims are made by their own job queue, so that uploads do not wait for the partner api.
+CLAIM_WORKER_COUNT = 2
+CLAIM_QUEUE_SIZE = 1000
+CLAIM_MAX_RETRIES = 5
+CLAIM_BASE_DELAY = 10
+CLAIM_MAX_DELAY = 300
+CLAIM_TIME_BUDGET = 1800
+# Pending claims, e.g. lost with a restart or rejected by a full claim queue, are scheduled again this often.
+CLAIM_RECOVERY_SECONDS = 60 * 60
+
+_content_owner_ids = {}
+_content_owner_ids_lock = threading.Lock()
+
+claim_queue = JobQueue(int(config_property('claim.worker_count', CLAIM_WORKER_COUNT)),
+                       int(config_property('claim.queue_size', CLAIM_QUEUE_SIZE)), name='claim-worker')
+claim_retry_policy = RetryPolicy(int(config_property('claim.max_retries', CLAIM_MAX_RETRIES)),
+                                 float(config_property('claim.base_delay', CLAIM_BASE_DELAY)),
+                                 float(config_property('claim.max_delay', CLAIM_MAX_DELAY)),
+                                 float(config_property('claim.time_budget', CLAIM_TIME_BUDGET)))
 
 
 def youtube_inst():
@@ -20,28 +52,38 @@ def youtube_inst():
     - Youtube partner scope
     - Youtube Upload Scope
     - Youtube force-ssl Scope
+
+    The built services are cached, see cached_service().
     """
+    return cached_service(CLIENT_SECRETS_FILE, _build_youtube_services)
 
+
+def _build_youtube_services():
     credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        APP_ROOT + '/config/client_secrets.json', scopes=youtube_scopes)
+        CLIENT_SECRETS_FILE, scopes=youtube_scopes)
 
     http = httplib2.Http()
     http = credentials.authorize(http)
 
-    youtube = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-                    http=http)
+    youtube = build_service(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
+                            http=http, quota_project=QUOTA_PROJECT)
 
-    youtube_partner = build(YOUTUBE_CONTENT_ID_API_SERVICE_NAME,
-                            YOUTUBE_CONTENT_ID_API_VERSION, http=http)
+    youtube_partner = build_service(YOUTUBE_CONTENT_ID_API_SERVICE_NAME,
+                                    YOUTUBE_CONTENT_ID_API_VERSION, http=http)
 
     return youtube, youtube_partner
 
 
-def get_content_owner_id(youtube_partner):
+def get_content_owner_id(youtube_partner, credential=CLIENT_SECRETS_FILE):
     """ Function to gather the youtube content owner
     id. This id is required to upload a video to
-    a multi channel network on youtube.
+    a multi channel network on youtube. The id is
+    resolved once per credential and cached until
+    invalidate_content_owner_id() is called.
     """
+    with _content_owner_ids_lock:
+        if credential in _content_owner_ids:
+            return _content_owner_ids[credential]
 
     try:
         content_owners_list_response = youtube_partner.contentOwners().list(
@@ -51,7 +93,20 @@ def get_content_owner_id(youtube_partner):
         raise Exception(
             'The request is not authorized by a Google Account that is linked to a YouTube content owner.') from e
 
-    return content_owners_list_response['items'][0]['id']
+    content_owner_id = content_owners_list_response['items'][0]['id']
+    with _content_owner_ids_lock:
+        _content_owner_ids[credential] = content_owner_id
+    return content_owner_id
+
+
+def invalidate_content_owner_id(credential=CLIENT_SECRETS_FILE):
+    with _content_owner_ids_lock:
+        _content_owner_ids.pop(credential, None)
+
+
+def _invalidate_content_owner_id_on_auth_error(exception):
+    if is_auth_error(exception):
+        invalidate_content_owner_id()
 
 
 def upload_video_to_youtube_mcn(video: VideoModel, registry: RegistryModel):
@@ -63,11 +118,18 @@ def upload_video_to_youtube_mcn(video: VideoModel, registry: RegistryModel):
         youtube, youtube_partner = youtube_inst()
         content_owner = get_content_owner_id(youtube_partner)
         channel_id = mapping.target_id
-        video_id = upload_video_to_youtube(youtube, video, registry, content_owner, channel_id)
-        claim_video_on_youtube(youtube_partner, content_owner, video_id, video, registry)
+        try:
+            upload_video_to_youtube(youtube, video, registry, content_owner, channel_id,
+                                    service_factory=lambda: youtube_inst()[0])
+        except SuccessWithWarningException:
+            # the video was uploaded, only setting thumbnail or captions failed
+            enqueue_claim(video, registry)
+            raise
+        enqueue_claim(video, registry)
     except SuccessWithWarningException as warning:
         raise warning
     except Exception as e:
+        _invalidate_content_owner_id_on_auth_error(e)
         raise Exception('Error initializing MCN youtube upload request for entry %s.' % registry.registry_id) from e
 
 
@@ -77,11 +139,123 @@ def update_video_on_youtube_mcn(video: VideoModel, registry: RegistryModel):
     try:
         youtube, youtube_partner = youtube_inst()
         content_owner = get_content_owner_id(youtube_partner)
-        update_video_on_youtube(youtube, video, registry, content_owner)
+        try:
+            update_video_on_youtube(youtube, video, registry, content_owner)
+        except SuccessWithWarningException:
+            # the video was updated, only setting thumbnail or captions failed
+            if registry.claim_status in ('pending', 'failed'):
+                enqueue_claim(video, registry)
+            raise
+        if registry.claim_status in ('pending', 'failed'):
+            enqueue_claim(video, registry)
+    except SuccessWithWarningException as warning:
+        raise warning
     except Exception as e:
+        _invalidate_content_owner_id_on_auth_error(e)
         raise Exception('Error initializing MCN youtube update request for entry %s.' % registry.registry_id) from e
 
 
+def update_videos_on_youtube_mcn(videos_and_registries):
+    """ Updates the videos of many registry entries, the metadata is updated with batched requests.
+
+    :param videos_and_registries: list of tuples of video and registry entry
+    :return: dict mapping each registry id to None on success, to a SuccessWithWarningException if only
+    thumbnail or captions failed, otherwise to the error
+    """
+    try:
+        youtube, youtube_partner = youtube_inst()
+        content_owner = get_content_owner_id(youtube_partner)
+        results = update_videos_on_youtube(youtube, videos_and_registries, content_owner)
+    except Exception as e:
+        _invalidate_content_owner_id_on_auth_error(e)
+        raise Exception('Error initializing MCN youtube bulk update request for %s entries.' % len(
+            videos_and_registries)) from e
+    for video, registry in videos_and_registries:
+        error = results[registry.registry_id]
+        if error is None or isinstance(error, SuccessWithWarningException):
+            if registry.claim_status in ('pending', 'failed'):
+                enqueue_claim(video, registry)
+        else:
+            _invalidate_content_owner_id_on_auth_error(error)
+    return results
+
+
+def enqueue_claim(video: VideoModel, registry: RegistryModel):
+    """ Schedules the content id claim of the uploaded video of the registry entry (see claim_video_of_registry).
+    Pending claims are scheduled again with the next update of the entry or by recover_pending_claims,
+    e.g. after a restart or if the claim queue was full.
+    """
+    registry.set_claim_status_and_persist('pending')
+    try:
+        claim_queue.submit('claim %s' % registry.registry_id,
+                           partial(claim_video_of_registry, registry.registry_id, registry.target_platform_video_id,
+                                   video.title, video.description),
+                           key=registry.registry_id)
+    except QueueFullException as e:
+        log_warning('Claim of registry entry %s stays pending until it is recovered. %s' % (registry.registry_id, e))
+
+
+def recover_pending_claims():
+    """ Schedules all pending claims again (see enqueue_claim) and repeats this every
+    claim.recovery_seconds. Claims already in the claim queue are not scheduled twice.
+    """
+    try:
+        registry_models = RegistryModel.find_pending_claims()
+        for registry_id, registry in registry_models.items():
+            claim_queue.submit('claim %s' % registry_id,
+                               partial(_claim_video_of_pending_registry, registry_id, registry.video_id,
+                                       registry.target_platform_video_id),
+                               key=registry_id)
+        log_info('Recovered %s pending claims.' % len(registry_models))
+    except QueueFullException as e:
+        log_warning('Cannot recover all pending claims. %s' % e)
+    except Exception as e:
+        log_error(traceback.format_exc())
+        log_error('Cannot recover pending claims. %s' % e)
+    timer = threading.Timer(int(config_property('claim.recovery_seconds', CLAIM_RECOVERY_SECONDS)),
+                            recover_pending_claims)
+    timer.daemon = True
+    timer.start()
+
+
+def _claim_video_of_pending_registry(registry_id, video_id, target_platform_video_id):
+    video = VideoModel.create_from_video_id(video_id)
+    claim_video_of_registry(registry_id, target_platform_video_id, video.title, video.description)
+
+
+def claim_video_of_registry(registry_id, target_platform_video_id, title, description):
+    """ Performs all steps to claim an uploaded video. Executed by the claim queue. Failed steps are
+    retried according to the claim retry policy. The created asset is persisted with the registry
+    entry, so that retries do not create it again. If the claim finally fails, the entry stays
+    active with a warning message.
+    """
+    registry = RegistryModel.create_from_registry_id(registry_id)
+    if registry.claim_status == 'claimed':
+        return
+    backoff = claim_retry_policy.start()
+    while True:
+        try:
+            youtube, youtube_partner = youtube_inst()
+            content_owner = get_content_owner_id(youtube_partner)
+            if not registry.asset_id:
+                registry.set_asset_id_and_persist(create_asset(youtube_partner, content_owner, title, description))
+            set_asset_ownership(youtube_partner, content_owner, registry.asset_id)
+            claim_video(youtube_partner, content_owner, registry.asset_id, target_platform_video_id)
+            registry.set_claim_status_and_persist('claimed')
+            log_info('Claimed video %s of registry entry %s.' % (target_platform_video_id, registry_id))
+            return
+        except Exception as e:
+            _invalidate_content_owner_id_on_auth_error(e)
+            log_error('Error setting policies on video with id on target platform "%s" of registry entry %s. Error %s' % (
+                target_platform_video_id, registry_id, e))
+            try:
+                backoff.wait(str(e))
+            except RetryLimitExceededException:
+                registry.claim_status = 'failed'
+                registry.set_message_and_persist('Warning while setting policies: %s' % e)
+                raise Exception('Cannot claim video of registry entry %s.' % registry_id) from e
+
+
 def unpublish_video_on_youtube_mcn(video: VideoModel, registry: RegistryModel):
     if registry.target_platform_video_id is None or registry.intermediate_state not in ('unpublishing', 'deleting'):
         raise Exception('Unpublishing not triggered because registry %s is not in correct state' % registry.registry_id)
@@ -90,9 +264,32 @@ def unpublish_video_on_youtube_mcn(video: VideoModel, registry: RegistryModel):
         content_owner = get_content_owner_id(youtube_partner)
         unpublish_video_on_youtube(youtube, video, registry, content_owner)
     except Exception as e:
+        _invalidate_content_owner_id_on_auth_error(e)
         raise Exception('Error initializing MCN youtube unpublish request for entry %s.' % registry.registry_id) from e
 
 
 def delete_video_on_youtube_mcn(video: VideoModel, registry: RegistryModel):
     unpublish_video_on_youtube_mcn(video, registry)
 
+
+def quota_available_for_youtube_mcn(priority):
+    return quota_available(QUOTA_PROJECT, priority)
+
+
+def unpublish_videos_on_youtube_mcn(registries):
+    """ Unpublishes the videos of many registry entries with batched requests.
+
+    :return: dict mapping each registry id to None on success, otherwise to the error
+    """
+    try:
+        youtube, youtube_partner = youtube_inst()
+        content_owner = get_content_owner_id(youtube_partner)
+        results = unpublish_videos_on_youtube(youtube, registries, content_owner)
+    except Exception as e:
+        _invalidate_content_owner_id_on_auth_error(e)
+        raise Exception('Error initializing MCN youtube bulk unpublish request for %s entries.' % len(registries)) from e
+    for error in results.values():
+        if error is not None:
+            _invalidate_content_owner_id_on_auth_error(error)
+    return results
+
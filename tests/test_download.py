@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from connector import download
+from connector.download import _download_remainder, PipelinedDownload, DownloadError
+
+VIDEO = bytes(range(256)) * 40
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=b'', headers=None, fail_after=None, observe=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.fail_after = fail_after
+        self.observe = observe
+
+    def iter_content(self, block_size):
+        for start in range(0, len(self.body), block_size):
+            if self.fail_after is not None and start >= self.fail_after:
+                raise requests.ConnectionError('Connection dropped.')
+            if self.observe is not None:
+                self.observe()
+            yield self.body[start:start + block_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+
+class DownloadRemainderTest(unittest.TestCase):
+    url = 'http://kaltura/flavor'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'video.mpeg')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.filename, 'wb') as file:
+            file.write(content)
+
+    def read(self):
+        with open(self.filename, 'rb') as file:
+            return file.read()
+
+    def test_complete_file_is_accepted_on_unsatisfiable_range(self):
+        self.write(b'0123456789')
+        session = FakeSession(FakeResponse(416, headers={'Content-Range': 'bytes */10'}))
+
+        result = _download_remainder(session, self.url, self.filename, None, '"v1"')
+
+        self.assertEqual((10, '"v1"'), result)
+        self.assertEqual('bytes=10-', session.requests[0]['Range'])
+        self.assertEqual(b'0123456789', self.read())
+
+    def test_unsatisfiable_range_of_other_size_fails(self):
+        self.write(b'0123456789')
+        session = FakeSession(FakeResponse(416, headers={'Content-Range': 'bytes */8'}))
+
+        with self.assertRaises(OSError):
+            _download_remainder(session, self.url, self.filename, None, '"v1"')
+
+    def test_partial_file_is_resumed_if_range_matches(self):
+        self.write(b'01234')
+        session = FakeSession(FakeResponse(206, b'56789', {'Content-Range': 'bytes 5-9/10'}))
+
+        result = _download_remainder(session, self.url, self.filename, 10, '"v1"')
+
+        self.assertEqual((10, '"v1"'), result)
+        self.assertEqual({'Accept-Encoding': 'identity', 'Range': 'bytes=5-', 'If-Range': '"v1"'},
+                         session.requests[0])
+        self.assertEqual(b'0123456789', self.read())
+
+    def test_partial_file_is_replaced_if_resource_changed(self):
+        self.write(b'01234')
+        session = FakeSession(FakeResponse(200, b'abcdefghijkl', {'Content-Length': '12', 'ETag': '"v2"'}))
+
+        result = _download_remainder(session, self.url, self.filename, 10, '"v1"')
+
+        self.assertEqual((12, '"v2"'), result)
+        self.assertEqual(b'abcdefghijkl', self.read())
+
+    def test_partial_file_without_validator_is_not_resumed(self):
+        self.write(b'stale')
+        session = FakeSession(FakeResponse(200, b'0123456789', {'Content-Length': '10',
+                                                                 'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT'}))
+
+        result = _download_remainder(session, self.url, self.filename, None, None)
+
+        self.assertEqual((10, 'Sun, 18 Oct 2026 10:00:00 GMT'), result)
+        self.assertNotIn('Range', session.requests[0])
+        self.assertEqual(b'0123456789', self.read())
+
+
+def video_response(offset=0, **kwargs):
+    return FakeResponse(206 if offset else 200, VIDEO[offset:], {'Content-Length': str(len(VIDEO) - offset)}, **kwargs)
+
+
+class PipelinedDownloadTest(unittest.TestCase):
+    url = 'http://kaltura/flavor'
+    max_buffer_size = 100
+
+    def setUp(self):
+        for patch in (mock.patch.object(download, 'BLOCK_SIZE', 10),
+                      mock.patch.object(download, 'RETRY_WAIT_SECONDS', 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def open(self, session):
+        with mock.patch.object(download.requests, 'Session', return_value=session):
+            stream = PipelinedDownload(self.url, self.max_buffer_size)
+        self.addCleanup(stream.close)
+        return stream
+
+    def wait_until_stalled(self, stream):
+        received = -1
+        while received != stream._received():
+            received = stream._received()
+            time.sleep(0.05)
+        return received
+
+    def test_seeking_ahead_of_received_bytes_discards_them(self):
+        buffered = []
+        streams = []
+        session = FakeSession(video_response(observe=lambda: buffered.extend(len(s._buffer) for s in streams)))
+        stream = self.open(session)
+        streams.append(stream)
+
+        stream.seek(9000)
+
+        self.assertEqual(VIDEO[9000:9050], stream.read(50))
+        self.assertLessEqual(max(buffered), self.max_buffer_size)
+
+    def test_stream_is_resumed_after_dropped_connection(self):
+        session = FakeSession(video_response(fail_after=500), video_response(500))
+        stream = self.open(session)
+
+        self.assertEqual(VIDEO, stream.read(len(VIDEO)))
+        self.assertEqual('bytes=500-', session.requests[1]['Range'])
+
+    def test_seeking_back_behind_discarded_bytes_fails(self):
+        stream = self.open(FakeSession(video_response()))
+        stream.read(50)
+        stream.seek(200)
+
+        with self.assertRaises(DownloadError):
+            stream.seek(100)
+
+    def test_buffer_is_bounded_ahead_of_readers(self):
+        stream = self.open(FakeSession(video_response()))
+
+        received = self.wait_until_stalled(stream)
+
+        self.assertLessEqual(received, self.max_buffer_size + download.BLOCK_SIZE)
+        self.assertEqual(VIDEO[:30], stream.read(30))
+
+
+if __name__ == '__main__':
+    unittest.main()
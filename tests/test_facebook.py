@@ -0,0 +1,209 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from connector import facebook
+from connector.facebook import upload_video_to_facebook_chunked, MultipartChunkBody, update_videos_on_facebook
+from connector.retry import RetryPolicy
+from connector.youtube import SuccessWithWarningException
+
+VIDEO = bytes(range(256)) * 4
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None, content=b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.content = json.dumps(body).encode('UTF-8') if body is not None else content
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, block_size):
+        for start in range(0, len(self.content), block_size):
+            yield self.content[start:start + block_size]
+
+    def close(self):
+        pass
+
+
+class FakeKalturaSession(object):
+    """ Serves VIDEO, honouring range requests. """
+
+    def get(self, url, headers=None, **kwargs):
+        offset = int(headers['Range'][len('bytes='):-1]) if 'Range' in headers else 0
+        return FakeResponse(206 if offset else 200, content=VIDEO[offset:],
+                            headers={'Content-Length': str(len(VIDEO) - offset)})
+
+    def close(self):
+        pass
+
+
+class FakeGraphSession(object):
+    """ Graph api answering transfer requests with the given responses, the default one accepts the chunk. """
+
+    def __init__(self, *transfer_responses):
+        self.transfer_responses = list(transfer_responses)
+        self.calls = []
+        self.received = b''
+
+    def post(self, url, data=None, **kwargs):
+        if isinstance(data, MultipartChunkBody):
+            chunk = b''.join(data)
+            self.calls.append('transfer')
+            if self.transfer_responses:
+                return self.transfer_responses.pop(0)
+            self.received = self.received[:data._offset] + chunk[len(data._preamble):-len(data._epilogue)]
+            end = len(self.received)
+            return FakeResponse(200, dict(start_offset=end, end_offset=min(end + len(VIDEO) // 2, len(VIDEO))))
+        self.calls.append(data['upload_phase'])
+        if data['upload_phase'] == 'start':
+            return FakeResponse(200, dict(upload_session_id='new', video_id='video', start_offset=0,
+                                          end_offset=len(VIDEO) // 2))
+        return FakeResponse(200, dict(id='video'))
+
+
+class FakeRegistry(object):
+    registry_id = 'registry'
+    mapping_id = 'mapping'
+    target_platform_video_id = None
+    intermediate_state = 'uploading'
+
+    def __init__(self, upload_session):
+        self.upload_session = upload_session
+        self.status = 'notified'
+
+    def set_upload_session_and_persist(self, upload_session):
+        self.upload_session = upload_session
+
+    def set_state_and_persist(self, state):
+        self.status = state
+
+
+class FakeVideo(object):
+    download_url = 'http://kaltura/flavor'
+    filename = None
+    image_filename = None
+    title = 'title'
+    description = 'description'
+
+
+class ChunkedUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        patches = [
+            mock.patch('connector.download.requests.Session', FakeKalturaSession),
+            mock.patch.object(facebook, '_pipelined_upload', return_value=True),
+            mock.patch.object(facebook.MappingModel, 'create_from_mapping_id',
+                              return_value=mock.Mock(target_id='token')),
+            mock.patch.object(facebook, 'upload_retry_policy', RetryPolicy(2, 1, 1, 10, sleep=self.sleeps.append))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def resumed_session(self):
+        return dict(platform='facebook', session_id='old', video_id='old-video', start_offset=len(VIDEO) // 2,
+                    end_offset=len(VIDEO), file_size=len(VIDEO))
+
+    def test_expired_resumed_session_restarts_from_the_start_of_the_stream(self):
+        graph = FakeGraphSession(FakeResponse(400, {'error': {'code': 6000, 'error_subcode': 1363030}}))
+        registry = FakeRegistry(self.resumed_session())
+
+        with mock.patch.object(facebook, 'session', graph):
+            upload_video_to_facebook_chunked(FakeVideo(), registry)
+
+        self.assertEqual(['transfer', 'start', 'transfer', 'transfer', 'finish'], graph.calls)
+        self.assertEqual(VIDEO, graph.received)
+        self.assertEqual([], self.sleeps)
+        self.assertEqual('active', registry.status)
+        self.assertEqual('video', registry.target_platform_video_id)
+
+    def test_failing_resumed_session_is_kept_for_the_next_attempt(self):
+        graph = FakeGraphSession(*[FakeResponse(503, {'error': {'code': 2}})] * 3)
+        registry = FakeRegistry(self.resumed_session())
+
+        with mock.patch.object(facebook, 'session', graph):
+            with self.assertRaises(Exception):
+                upload_video_to_facebook_chunked(FakeVideo(), registry)
+
+        self.assertEqual(['transfer'] * 3, graph.calls)
+        self.assertEqual(self.resumed_session(), registry.upload_session)
+
+
+class FakeBatchGraphSession(object):
+    """ Graph api answering batch requests operation by operation and failing thumbnail uploads. """
+
+    def __init__(self):
+        self.batches = []
+        self.thumbnails = []
+
+    def post(self, url, data=None, files=None, **kwargs):
+        if 'batch' in data:
+            batch = json.loads(data['batch'])
+            self.batches.append(batch)
+            return FakeResponse(200, [dict(code=200, body='{"success": true}') for operation in batch])
+        if 'thumb' in files:
+            self.thumbnails.append(url)
+            return FakeResponse(500, content=b'thumbnail rejected')
+        return FakeResponse(500, content=b'unexpected request')
+
+
+class UpdateRegistry(FakeRegistry):
+    intermediate_state = 'updating'
+    captions_uploaded = False
+    video_hash_code = 'old'
+    message = None
+
+    def __init__(self, registry_id):
+        super().__init__(None)
+        self.registry_id = registry_id
+        self.target_platform_video_id = 'video-%s' % registry_id
+
+
+class UpdateVideo(FakeVideo):
+    captions_filename = None
+
+    def __init__(self, video_id, hash_code, image_filename=None):
+        self.video_id = video_id
+        self.hash_code = hash_code
+        self.image_filename = image_filename
+
+
+class BulkUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patch = mock.patch.object(facebook.MappingModel, 'create_from_mapping_id',
+                                  return_value=mock.Mock(target_id='token'))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_changed_metadata_is_sent_in_one_batch_and_thumbnails_per_video(self):
+        image_filename = os.path.join(self.directory, 'thumb.jpg')
+        with open(image_filename, 'wb') as image:
+            image.write(b'jpg')
+        graph = FakeBatchGraphSession()
+        entries = [(UpdateVideo('1', 'new', image_filename), UpdateRegistry('1')),
+                   (UpdateVideo('2', 'new'), UpdateRegistry('2')),
+                   (UpdateVideo('3', 'old'), UpdateRegistry('3'))]
+
+        with mock.patch.object(facebook, 'session', graph):
+            results = update_videos_on_facebook(entries)
+
+        self.assertEqual(1, len(graph.batches))
+        self.assertEqual(['video-1', 'video-2'], [operation['relative_url'] for operation in graph.batches[0]])
+        self.assertEqual([facebook.API_URL + 'video-1'], graph.thumbnails)
+        self.assertIsInstance(results['1'], SuccessWithWarningException)
+        self.assertIn('thumbnail rejected', entries[0][1].message)
+        self.assertIsNone(results['2'])
+        self.assertIsNone(results['3'])
+
+if __name__ == '__main__':
+    unittest.main()